@@ -2,20 +2,33 @@ import datetime
 import json
 from functools import wraps
 import random
+import time
 
 import webapp2
-from google.appengine.ext.webapp import template
 from google.appengine.ext import ndb
 from google.appengine.api import users
+from google.appengine.api import taskqueue
 
-from views_base import ViewBase
+from views_base import ViewBase, get_page_size
+from user_views import LIVE_VOTE_BATCH_DELAY
 
-from models import (Show, Player, PlayerAction, ShowPlayer, ShowAction, Action,
-					Theme, ActionVote, ThemeVote,
-					VotingTest, LiveVotingTest, RoleVote,
+from models import (Show, Player, Action, Theme,
 					VOTE_AFTER_INTERVAL, ROLE_TYPES, VOTE_TYPES,
-					get_current_show)
-from timezone import get_mountain_time, back_to_tz
+					get_current_show, invalidate_current_show,
+					DeleteJob, create_show, create_voting_tests,
+					get_unused_count)
+from leaderboard import get_leaderboard_page
+from timezone import get_mountain_time, back_to_tz, get_epoch_ms
+
+DELETE_QUEUE = 'deletes'
+VOTE_RESULT_QUEUE = 'vote-results'
+# Seconds past the end of a vote that its result waits, on top of the live
+# vote batch delay, for the batches of the last votes to be recorded
+VOTE_RESULT_MARGIN = 5
+# Seconds a delete job task works before handing over to the next task
+DELETE_JOB_SECONDS = 20
+# Latest delete jobs listed on the delete tools page
+DELETE_JOBS_SHOWN = 5
 
 
 def admin_required(func):
@@ -28,30 +41,54 @@ def admin_required(func):
     return decorated_view
 
 
-#### RESETS LIVE ACTION VOTES ####
-def reset_action_live_votes():
-	reset_actions = Action.query(Action.used == False,
-				 				 Action.live_vote_value > 0).fetch()
-	# Reset all actions that haven't been used, but have a live_vote_value, to zero
-	for ra in reset_actions:
-		# Set the actions live_vote_value to zero
-		ra.live_vote_value = 0
-		ra.put()
+def get_vote_start(show, vote_type):
+	# Start of the current run of a vote, in epoch milliseconds
+	return get_epoch_ms(getattr(show, '%s_vote_init' % vote_type))
+
+
+def schedule_vote_result(show, vote_type):
+	# Store the result of the vote once the voting period is over
+	vote_start = get_vote_start(show, vote_type)
+	# Named after the start of the vote, so each start only has one task
+	try:
+		taskqueue.add(url='/vote_result_worker/',
+					  name='vote-result-%s-%s-%s' % (show.key.id(), vote_type,
+					  								 vote_start),
+					  params={'show_id': show.key.id(),
+					  		  'vote_type': vote_type,
+					  		  'interval': show.current_interval,
+					  		  'vote_start': vote_start},
+					  countdown=(VOTE_AFTER_INTERVAL + LIVE_VOTE_BATCH_DELAY
+					  			 + VOTE_RESULT_MARGIN),
+					  queue_name=VOTE_RESULT_QUEUE)
+	except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+		pass
+
+
+@ndb.transactional
+def save_delete_job(job):
+	# Queue the next batches of the job along with saving its progress
+	job.put()
+	if not job.finished:
+		taskqueue.add(url='/delete_job_worker/',
+					  params={'job_id': job.key.id()},
+					  queue_name=DELETE_QUEUE,
+					  transactional=True)
 
 
 class ShowPage(ViewBase):
 	@admin_required
 	def get(self, show_id):
 		show = ndb.Key(Show, int(show_id)).get()
-		available_actions = len(Action.query(
-							   Action.used == False).fetch())
+		available_actions = get_unused_count(Action)
 		context	= {'show': show,
 				   'now_tz': back_to_tz(get_mountain_time()),
 				   'available_actions': available_actions,
 				   'host_url': self.request.host_url,
 				   'VOTE_AFTER_INTERVAL': VOTE_AFTER_INTERVAL}
-		self.response.out.write(template.render(self.path('show.html'),
-												self.add_context(context)))
+		context['show_header'] = self.render_fragment('show_header.html', show,
+													  context)
+		self.response.out.write(self.render('show.html', context))
 	
 	@admin_required
 	def post(self, show_id):
@@ -67,48 +104,46 @@ class ShowPage(ViewBase):
 				# Set the start time of this interval vote
 				show.interval_vote_init = get_mountain_time()
 				show.put()
-			# Reset all actions that haven't been used, but have a live_vote_value, to zero
-			reset_action_live_votes()
+				# Pick the interval's vote options up front
+				show.get_randomized_unused_actions(show, next_interval)
+				schedule_vote_result(show, 'interval')
 		# Admin is starting item vote
 		elif self.request.get('test_vote') and self.context.get('is_admin', False):
+			# Make sure the test vote options exist before the vote opens
+			create_voting_tests()
 			show.test = None
-			# Delete all live voting test votes
-			for lvt in LiveVotingTest.query().fetch():
-				lvt.key.delete()
-			# Delete all voting test objects
-			for vt in VotingTest.query().fetch():
-				vt.key.delete()
-			# Create a set of five test votes
-			VotingTest(name="I'M JAZZED! START THE SHOW ALREADY!").put()
-			VotingTest(name="I'm VERY interested in... whatever this is...").put()
-			VotingTest(name="Present").put()
-			VotingTest(name="Meh").put()
-			VotingTest(name="If you notice me sleeping in the audience, try and keep it down. Thanks.").put()
-
+			# Start a new round, so the votes of earlier rounds don't count
+			show.test_round = (show.test_round or 0) + 1
 			show.test_vote_init = get_mountain_time()
 			show.put()
+			schedule_vote_result(show, 'test')
 		# Admin is starting hero vote
 		elif self.request.get('hero_vote') and self.context.get('is_admin', False):
 			show.hero_vote_init = get_mountain_time()
 			show.put()
+			schedule_vote_result(show, 'hero')
 		# Admin is starting villain vote
 		elif self.request.get('villain_vote') and self.context.get('is_admin', False):
 			show.villain_vote_init = get_mountain_time()
 			show.put()
+			schedule_vote_result(show, 'villain')
 		# Admin is starting incident vote
 		elif self.request.get('incident_vote') and self.context.get('is_admin', False):
-			# Set all actions that haven't been used, but have a live_vote_value, to zero
-			reset_action_live_votes()
 			show.incident_vote_init = get_mountain_time()
+			# Vote on the same actions for the whole incident vote
+			show.store_incident_vote_options(show)
 			show.put()
+			schedule_vote_result(show, 'incident')
 		# Admin is starting the shapeshifter vote
 		elif self.request.get('shapeshifter_vote') and self.context.get('is_admin', False):
 			show.shapeshifter_vote_init = get_mountain_time()
 			show.put()
+			schedule_vote_result(show, 'shapeshifter')
 		# Admin is starting the lover vote
 		elif self.request.get('lover_vote') and self.context.get('is_admin', False):
 			show.lover_vote_init = get_mountain_time()
 			show.put()
+			schedule_vote_result(show, 'lover')
 		# Admin is starting a recap
 		elif self.request.get('recap') and self.context.get('is_admin', False):
 			show.recap_init = get_mountain_time()
@@ -119,25 +154,43 @@ class ShowPage(ViewBase):
 			# Toggle the lock/unlock
 			show.locked = not show.locked
 			show.put()
-		available_actions = len(Action.query(
-							   Action.used == False).fetch())
+		# Don't serve the show from before this change
+		invalidate_current_show()
+		available_actions = get_unused_count(Action)
 		context	= {'show': show,
 				   'now_tz': back_to_tz(get_mountain_time()),
 				   'available_actions': available_actions,
 				   'host_url': self.request.host_url,
 				   'VOTE_AFTER_INTERVAL': VOTE_AFTER_INTERVAL}
-		self.response.out.write(template.render(self.path('show.html'),
-												self.add_context(context)))		
+		context['show_header'] = self.render_fragment('show_header.html', show,
+													  context)
+		self.response.out.write(self.render('show.html', context))		
+
+
+class VoteResultWorker(webapp2.RequestHandler):
+	def post(self):
+		show = ndb.Key(Show, int(self.request.get('show_id'))).get()
+		vote_type = self.request.get('vote_type')
+		# If the vote was restarted, leave it to the new start's task
+		if str(get_vote_start(show, vote_type)) != self.request.get('vote_start'):
+			return
+		interval = self.request.get('interval')
+		if interval and interval != 'None':
+			interval = int(interval)
+		else:
+			interval = None
+		show.finalize_vote(vote_type, interval)
 
 
 class CreateShow(ViewBase):
 	@admin_required
 	def get(self):
+		themes, next_theme_cursor = get_leaderboard_page(
+										Theme, size=get_page_size(self.request))
 		context = {'players': Player.query().fetch(),
-				   'themes': Theme.query(Theme.used == False,
-				   				).order(-Theme.vote_value).fetch()}
-		self.response.out.write(template.render(self.path('create_show.html'),
-												self.add_context(context)))
+				   'themes': themes,
+				   'next_theme_cursor': next_theme_cursor}
+		self.response.out.write(self.render('create_show.html', context))
 
 	@admin_required
 	def post(self):
@@ -145,8 +198,11 @@ class CreateShow(ViewBase):
 		theme_id = self.request.get('theme_id')
 		player_list = self.request.get_all('player_list')
 		action_intervals = self.request.get('action_intervals')
+		themes, next_theme_cursor = get_leaderboard_page(
+										Theme, size=get_page_size(self.request))
 		context = {'players': Player.query().fetch(),
-		           'themes': Theme.query(Theme.used == False).fetch()}
+				   'themes': themes,
+				   'next_theme_cursor': next_theme_cursor}
 		if player_list and action_intervals:
 			# Get the list of interval times
 			try:
@@ -159,121 +215,106 @@ class CreateShow(ViewBase):
 			else:
 				scheduled = get_mountain_time()
 			theme = ndb.Key(Theme, int(theme_id))
-			show = Show(scheduled=scheduled, theme=theme).put()
-			players = []
-			# Add the players to the show
-			for player in player_list:
-				player_key = ndb.Key(Player, int(player)).get().key
-				players.append(player_key)
-				ShowPlayer(show=show, player=player_key).put()
+			# Get the players of the show, in a single batch
+			players = [x.key for x in ndb.get_multi(
+							[ndb.Key(Player, int(x)) for x in player_list]) if x]
 			# Make a copy of the list of players and randomize it
 			rand_players = list(players)
 			random.shuffle(rand_players, random.random)
+			interval_players = []
 			# Add the action intervals to the show
 			for interval in interval_list:
 				# If random players list gets empty, refill it with more players
 				if len(rand_players) == 0:
 					rand_players = list(players)
 					random.shuffle(rand_players, random.random)
-				# Pop a random player off the list and create a PlayerAction
-				player_action = PlayerAction(interval=interval,
-											 player=rand_players.pop()).put()
-				ShowAction(show=show, player_action=player_action).put()
+				# Pop a random player off the list for the interval
+				interval_players.append((interval, rand_players.pop()))
+			# Write the show and everything in it at once
+			create_show(Show(scheduled=scheduled, theme=theme), players,
+						interval_players)
+			# The new show may be today's show
+			invalidate_current_show()
 			context['created'] = True
-		self.response.out.write(template.render(self.path('create_show.html'),
-												self.add_context(context)))
+		self.response.out.write(self.render('create_show.html', context))
 
 
 class DeleteTools(ViewBase):
+	def unused_pages(self, new_job=None):
+		# Get the first page of un-used actions and themes
+		page_size = get_page_size(self.request)
+		actions, next_action_cursor = get_leaderboard_page(Action, size=page_size)
+		themes, next_theme_cursor = get_leaderboard_page(Theme, size=page_size)
+		delete_jobs = DeleteJob.query().order(
+							-DeleteJob.created).fetch(DELETE_JOBS_SHOWN)
+		# The query may not find a job that was just saved
+		if new_job:
+			delete_jobs = [new_job] + [x for x in delete_jobs
+									   if x.key != new_job.key]
+			delete_jobs = delete_jobs[:DELETE_JOBS_SHOWN]
+		return {'actions': actions,
+				'next_action_cursor': next_action_cursor,
+				'themes': themes,
+				'next_theme_cursor': next_theme_cursor,
+				'delete_jobs': delete_jobs}
+
 	@admin_required
 	def get(self):
-		context = {'shows': Show.query().fetch(),
-				   'actions': Action.query(Action.used == False).fetch(),
-				   'themes': Theme.query(Theme.used == False).fetch()}
-		self.response.out.write(template.render(self.path('delete_tools.html'),
-												self.add_context(context)))
+		context = {'shows': Show.query().fetch()}
+		context.update(self.unused_pages())
+		self.response.out.write(self.render('delete_tools.html', context))
 
 	@admin_required
 	def post(self):
-		deleted = None
-		unused_deleted = False
 		show_list = self.request.get_all('show_list')
 		action_list = self.request.get_all('action_list')
-		item_list = self.request.get_all('item_list')
-		character_list = self.request.get_all('character_list')
 		theme_list = self.request.get_all('theme_list')
 		delete_unused = self.request.get_all('delete_unused')
-		# If action(s) were deleted
+		targets = [ndb.Key(Action, int(x)) for x in action_list]
+		targets += [ndb.Key(Theme, int(x)) for x in theme_list]
+		targets += [ndb.Key(Show, int(x)) for x in show_list]
+		descriptions = []
 		if action_list:
-			for action in action_list:
-				action_entity = ndb.Key(Action, int(action)).get()
-				# Get all the related action votes and delete them
-				action_votes = ActionVote.query(ActionVote.action == action_entity.key).fetch()
-				for av in action_votes:
-					av.key.delete()
-				action_entity.key.delete()
-			deleted = 'Action(s)'
-		# If theme(s) were deleted
+			descriptions.append('Action(s)')
 		if theme_list:
-			for theme in theme_list:
-				theme_entity = ndb.Key(Theme, int(theme)).get()
-				# Get all the related theme votes and delete them
-				theme_votes = ThemeVote.query(ThemeVote.theme == theme_entity.key).fetch()
-				for tv in theme_votes:
-					tv.key.delete()
-				theme_entity.key.delete()
-			deleted = 'Theme(s)'
-		# If show(s) were deleted
+			descriptions.append('Theme(s)')
 		if show_list:
-			for show in show_list:
-				show_entity = ndb.Key(Show, int(show)).get()
-				show_actions = ShowAction.query(ShowAction.show == show_entity.key).fetch()
-				# Delete the actions that occurred within the show
-				for show_action in show_actions:
-					action = show_action.player_action.get().action
-					if action:
-						action.delete()
-					show_action.player_action.delete()
-					show_action.key.delete()
-				# Delete player associations to the show
-				show_players = ShowPlayer.query(ShowPlayer.show == show_entity.key).fetch()
-				for show_player in show_players:
-					show_player.key.delete()
-				# Delete all Role votes
-				role_votes = RoleVote.query(RoleVote.show == show_entity.key).fetch()
-				for role_vote in role_votes:
-					role_vote.key.delete()
-				# Delete the theme used in the show, if it existed
-				if show_entity.theme:
-					show_entity.theme.delete()
-				show_entity.key.delete()
-				deleted = 'Show(s)'
+			descriptions.append('Show(s)')
 		# Delete ALL un-used things
 		if delete_unused:
-			# Delete Un-used Actions
-			unused_actions = Action.query(Action.used == False).fetch()
-			for unused_action in unused_actions:
-				# Get all the related action votes and delete them
-				action_votes = ActionVote.query(ActionVote.action == unused_action.key).fetch()
-				for av in action_votes:
-					av.key.delete()
-				# Delete the un-used actions
-				unused_action.key.delete()
-			deleted = 'All Un-used Actions'
-		context = {'deleted': deleted,
-				   'unused_deleted': unused_deleted,
-				   'shows': Show.query().fetch(),
-				   'actions': Action.query(Action.used == False).fetch(),
-				   'themes': Theme.query(Theme.used == False).fetch()}
-		self.response.out.write(template.render(self.path('delete_tools.html'),
-												self.add_context(context)))
+			descriptions.append('All Un-used Actions')
+		deleting = None
+		job = None
+		# Delete the entities and everything related to them in the background
+		if descriptions:
+			deleting = ', '.join(descriptions)
+			job = DeleteJob(description=deleting,
+							targets=targets,
+							total=len(targets),
+							find_unused=bool(delete_unused))
+			save_delete_job(job)
+		context = {'deleting': deleting,
+				   'shows': Show.query().fetch()}
+		context.update(self.unused_pages(job))
+		self.response.out.write(self.render('delete_tools.html', context))
+
+
+class DeleteJobWorker(webapp2.RequestHandler):
+	def post(self):
+		job = ndb.Key(DeleteJob, int(self.request.get('job_id'))).get()
+		if not job or job.finished:
+			return
+		# Work through batches for a while, then continue in a new task
+		stop_time = time.time() + DELETE_JOB_SECONDS
+		while job.run_step() and time.time() < stop_time:
+			pass
+		save_delete_job(job)
 
 
 class AddPlayers(ViewBase):
 	@admin_required
 	def get(self):
-		self.response.out.write(template.render(self.path('add_players.html'),
-												self.add_context()))
+		self.response.out.write(self.render('add_players.html'))
 
 	@admin_required
 	def post(self):
@@ -292,8 +333,7 @@ class AddPlayers(ViewBase):
 				   date_added=date_added).put()
 			created = True
 		context = {'created': created}
-		self.response.out.write(template.render(self.path('add_players.html'),
-												self.add_context(context)))
+		self.response.out.write(self.render('add_players.html', context))
 
 
 class IntervalTimer(ViewBase):
@@ -301,8 +341,7 @@ class IntervalTimer(ViewBase):
 	def get(self):
 		context = {'show': get_current_show(),
 				  'now_tz': back_to_tz(get_mountain_time())}
-		self.response.out.write(template.render(self.path('interval_timer.html'),
-												self.add_context(context)))
+		self.response.out.write(self.render('interval_timer.html', context))
 
 
 class MockObject(object):
@@ -398,5 +437,4 @@ class JSTestPage(ViewBase):
 				   'VOTE_AFTER_INTERVAL': VOTE_AFTER_INTERVAL,
 				   'mocked': True,
 				   'mock_data': json.dumps(mock_data)}
-		self.response.out.write(template.render(self.path('js_test.html'),
-												self.add_context(context)))
+		self.response.out.write(self.render('js_test.html', context))
@@ -1,45 +1,58 @@
 import json
-import datetime
 
+import webapp2
 from google.appengine.ext import ndb
+from google.appengine.api import users
 
-from views_base import ViewBase
-from models import (Show, Action, Theme, ActionVote, ThemeVote)
-from timezone import get_mountain_time, back_to_tz
+from views_base import ViewBase, get_page_size
+from models import (Show, Action, Theme, ActionVote, ThemeVote, DeleteJob,
+                    show_today, get_show_state, wait_for_show_state,
+                    get_unused_count, get_voted_ids, insert_upvote)
+from leaderboard import get_leaderboard_page
 
 
-class ShowJSON(ViewBase):
+def get_version(request):
+    # The state version the client already has, if any
+    try:
+        return int(request.get('version'))
+    except ValueError:
+        return None
+
+
+class ShowJSON(webapp2.RequestHandler):
     def get(self, show_id):
-        show = ndb.Key(Show, int(show_id)).get()
-        vote_options = show.current_vote_options(show)
+        version = get_version(self.request)
+        # If the client already has a version, hold the request until it changes
+        if version is not None:
+            show_state = wait_for_show_state(show_id, version)
+        else:
+            show_state = get_show_state(show_id)
+        etag = '%s-%s' % (show_state['version'], show_state['etag'])
+        # Make clients revalidate every poll against the ETag
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['ETag'] = '"%s"' % etag
+        # If the client already has this version of the state
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return
         self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        self.response.out.write(json.dumps(vote_options))
+        self.response.out.write(json.dumps(show_state['vote_options']))
 
 
-class IntervalTimerJSON(ViewBase):
+class ShowTimelineJSON(webapp2.RequestHandler):
     def get(self, show_id):
-        time_json = {}
         show = ndb.Key(Show, int(show_id)).get()
-        interval_gap = show.get_interval_gap(show.current_interval)
-        if interval_gap:
-            # Set the end of this gap
-            gap_end = back_to_tz(show.interval_vote_init) + datetime.timedelta(minutes=interval_gap)
-        else:
-            gap_end = back_to_tz(get_mountain_time())
-        time_json.update({'hour': gap_end.hour,
-                          'minute': gap_end.minute,
-                          'second': gap_end.second})
         self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        self.response.out.write(json.dumps(time_json))
+        self.response.out.write(json.dumps(show.vote_timeline))
 
 
-class UpvoteJSON(ViewBase):
+class UpvoteJSON(webapp2.RequestHandler):
     def get(self):
     	response_dict = {}
-    	if self.context.get('show_today'):
-    		response_dict['item_count'] = Action.query(Action.used == False).count()
+    	if show_today():
+    		response_dict['item_count'] = get_unused_count(Action)
     	else:
-    		response_dict['item_count'] = Theme.query(Theme.used == False).count()
+    		response_dict['item_count'] = get_unused_count(Theme)
         self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
         self.response.out.write(json.dumps(response_dict))
     
@@ -49,16 +62,59 @@ class UpvoteJSON(ViewBase):
     	session_id = self.request.get('session_id')
     	# Splits the id into type and item id
     	item_type, item_id = posted_id.split('-')
+    	# Votes are keyed by item and session, so a repeated vote is dropped
     	if item_type == 'action':
-    		item = ndb.Key(Action, int(item_id)).get()
+    		item_key = ndb.Key(Action, int(item_id))
+    		vote = ActionVote(key=ActionVote.build_key(item_key, session_id),
+    						  action=item_key, session_id=session_id)
     	else:
-    		item = ndb.Key(Theme, int(item_id)).get()
-        # See if the user already voted for this item
-        if not session_id in item.get_voted_sessions:
-        	# if the voted item was an action
+    		item_key = ndb.Key(Theme, int(item_id))
+    		vote = ThemeVote(key=ThemeVote.build_key(item_key, session_id),
+    						 theme=item_key, session_id=session_id)
+    	# Store the vote and its vote value increment together
+    	insert_upvote(item_key, vote)
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.out.write(json.dumps({}))
+
+
+class ItemsJSON(ViewBase):
+    def get(self, item_type):
+        cursor = self.request.get('cursor')
+        if item_type == 'action':
+            model, vote_model = Action, ActionVote
+            rows_template = 'action_rows.html'
+        else:
+            model, vote_model = Theme, ThemeVote
+            rows_template = 'theme_rows.html'
+        items, next_cursor = get_leaderboard_page(model, cursor,
+                                                  get_page_size(self.request))
+        session_id = str(self.session.get('id', '0'))
+        # Render the next page of rows for the upvote pages
+        context = {'%ss' % item_type: items,
+                   'cursor': cursor,
+                   'session_id': session_id,
+                   'voted_ids': get_voted_ids(vote_model, items, session_id)}
+        rows_html = self.render(rows_template, context)
+        # Include the bare items for the admin select lists
+        item_list = []
+        for item in items:
             if item_type == 'action':
-            	ActionVote(action=item.key, session_id=session_id).put()
+                name = item.description
             else:
-            	ThemeVote(theme=item.key, session_id=session_id).put()
+                name = item.name
+            item_list.append({'id': item.key.id(), 'name': name})
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.out.write(json.dumps({'html': rows_html,
+                                            'cursor': next_cursor,
+                                            'items': item_list}))
+
+
+class DeleteJobJSON(webapp2.RequestHandler):
+    def get(self, job_id):
+        if not users.is_current_user_admin():
+            self.abort(403)
+        job = ndb.Key(DeleteJob, int(job_id)).get()
+        if not job:
+            self.abort(404)
         self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        self.response.out.write(json.dumps({}))
\ No newline at end of file
+        self.response.out.write(json.dumps(job.progress))
@@ -0,0 +1,210 @@
+import bisect
+import datetime
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+# Versioned, so boards cached with mixed date types are not read back
+LEADERBOARD_KEY = 'leaderboard-2-%s'
+# Attempts at a compare-and-set update before the leaderboard is dropped
+LEADERBOARD_RETRIES = 5
+# Most entities kept on a leaderboard, which keeps it well under the 1MB
+# memcache value limit. Pages past it are read from the datastore.
+LEADERBOARD_SIZE = 5000
+# Starts the cursors of pages read from the datastore
+QUERY_CURSOR_PREFIX = 'q'
+# Default and largest amount of entities in a page
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class Leaderboard(object):
+    """The top unused entities of a kind, ordered by (vote_value desc,
+    created asc).
+
+    Only the sort values and ids are kept, and only of the top
+    LEADERBOARD_SIZE entities, so the board fits in a single memcache value
+    and is updated in place as entities change. complete is False when
+    there are more unused entities than the board holds. The board is
+    always the exact top of the unused entities, just shorter.
+    """
+    def __init__(self, entities, complete=True):
+        entries = sorted([self.get_entry(x) for x in entities])
+        self.entries = entries[:LEADERBOARD_SIZE]
+        self.complete = complete and len(entries) <= LEADERBOARD_SIZE
+        self.entry_ids = dict([(x[2], x) for x in self.entries])
+
+    def __getstate__(self):
+        # The id lookup is rebuilt on load, rather than stored twice
+        return {'entries': self.entries, 'complete': self.complete}
+
+    def __setstate__(self, state):
+        self.entries = state['entries']
+        self.complete = state.get('complete', True)
+        self.entry_ids = dict([(x[2], x) for x in self.entries])
+
+    @staticmethod
+    def get_entry(entity):
+        created = entity.created
+        # Date properties are read back as dates, but may be set to a
+        # datetime, so every entry is ordered by a datetime
+        if not isinstance(created, datetime.datetime):
+            created = datetime.datetime.combine(created, datetime.time())
+        return (-(entity.vote_value or 0), created, entity.key.id())
+
+    def trim(self):
+        # Drop the entries past the size of the board
+        for entry in self.entries[LEADERBOARD_SIZE:]:
+            self.entry_ids.pop(entry[2], None)
+            self.complete = False
+        del self.entries[LEADERBOARD_SIZE:]
+
+    def remove(self, entity_id):
+        entry = self.entry_ids.pop(entity_id, None)
+        if entry:
+            del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    def update(self, entity):
+        self.remove(entity.key.id())
+        # Used entities drop off the board
+        if entity.used:
+            return
+        entry = self.get_entry(entity)
+        # Entities past the end of a partial board stay off it, as entities
+        # not on the board may rank above them
+        if not self.complete and (not self.entries or entry > self.entries[-1]):
+            return
+        bisect.insort(self.entries, entry)
+        self.entry_ids[entry[2]] = entry
+        self.trim()
+
+    def is_short(self):
+        # A partial board that has lost half its entries needs refilling
+        return not self.complete and len(self.entries) < LEADERBOARD_SIZE / 2
+
+    def top(self, amount=None):
+        # Ids of the top amount of entities, or all of them
+        return [x[2] for x in self.entries[:amount]]
+
+    def get_start(self, cursor=None):
+        """Position on the board of the page after a cursor.
+
+        The cursor holds the end position and id of the last entity on the
+        page. The next page starts after that entity, wherever it has moved
+        to, or where it used to be if it has left the board.
+        """
+        if not cursor:
+            return 0
+        try:
+            offset, last_id = [int(x) for x in cursor.split('-', 1)]
+        except ValueError:
+            offset, last_id = 0, None
+        last_rank = self.rank(last_id)
+        if last_rank != None:
+            return last_rank + 1
+        return max(offset - 1, 0)
+
+    def page(self, cursor=None, size=PAGE_SIZE):
+        """Get a page of ids, and the cursor of the following page.
+
+        A partial board always has a following page, which carries on
+        from the datastore once the board runs out.
+        """
+        start = self.get_start(cursor)
+        ids = [x[2] for x in self.entries[start:start + size]]
+        end = start + len(ids)
+        if ids and (end < len(self.entries) or not self.complete):
+            return ids, '%s-%s' % (end, ids[-1])
+        return ids, None
+
+    def rank(self, entity_id):
+        entry = self.entry_ids.get(entity_id)
+        if not entry:
+            return None
+        return bisect.bisect_left(self.entries, entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def get_ranked_query(model):
+    # Unused entities in leaderboard order, ties go to the lowest id
+    return model.query(model.used == False).order(-model.vote_value,
+                                                  model.created)
+
+
+def get_leaderboard(model):
+    leaderboard = memcache.get(LEADERBOARD_KEY % model._get_kind())
+    # If the leaderboard isn't cached, rebuild it from the datastore
+    if leaderboard is None:
+        # Only the sort values are needed, which the index already holds
+        entities = get_ranked_query(model).fetch(
+                        LEADERBOARD_SIZE + 1,
+                        projection=[model.vote_value, model.created])
+        leaderboard = Leaderboard(entities[:LEADERBOARD_SIZE],
+                                  len(entities) <= LEADERBOARD_SIZE)
+        memcache.add(LEADERBOARD_KEY % model._get_kind(), leaderboard)
+    return leaderboard
+
+
+def get_leaderboard_keys(model, amount=None):
+    return [ndb.Key(model, x) for x in get_leaderboard(model).top(amount)]
+
+
+def get_leaderboard_entities(model, amount=None):
+    # Skip any entities deleted since the leaderboard was updated
+    return [x for x in ndb.get_multi(get_leaderboard_keys(model, amount)) if x]
+
+
+def get_query_page(model, size, start_cursor=None, offset=0):
+    entities, cursor, more = get_ranked_query(model).fetch_page(
+                                size, start_cursor=start_cursor, offset=offset)
+    if more and entities:
+        return entities, '%s%s' % (QUERY_CURSOR_PREFIX, cursor.urlsafe())
+    return entities, None
+
+
+def get_leaderboard_page(model, cursor=None, size=PAGE_SIZE):
+    # Pages past the end of a partial leaderboard come from the datastore
+    if cursor and cursor.startswith(QUERY_CURSOR_PREFIX):
+        start_cursor = Cursor(urlsafe=cursor[len(QUERY_CURSOR_PREFIX):])
+        return get_query_page(model, size, start_cursor)
+    leaderboard = get_leaderboard(model)
+    ids, next_cursor = leaderboard.page(cursor, size)
+    entities = ndb.get_multi([ndb.Key(model, x) for x in ids])
+    # Skip any entities deleted since the leaderboard was updated
+    entities = [x for x in entities if x]
+    # Fill the rest of the page once a partial leaderboard runs out
+    if len(ids) < size and not leaderboard.complete:
+        more, next_cursor = get_query_page(
+                                model, size - len(ids),
+                                offset=leaderboard.get_start(cursor) + len(ids))
+        entities += more
+    return entities, next_cursor
+
+
+def _change_leaderboard(model, change):
+    client = memcache.Client()
+    leaderboard_key = LEADERBOARD_KEY % model._get_kind()
+    for i in range(0, LEADERBOARD_RETRIES):
+        leaderboard = client.gets(leaderboard_key)
+        # If it isn't cached, the next read rebuilds it with the change
+        if leaderboard is None:
+            return
+        change(leaderboard)
+        # Drop a board that's too short, so the next read rebuilds it
+        if leaderboard.is_short():
+            break
+        if client.cas(leaderboard_key, leaderboard):
+            return
+    # Too much contention, or too short, so the next read rebuilds it
+    memcache.delete(leaderboard_key)
+
+
+def update_leaderboard(entity):
+    _change_leaderboard(type(entity), lambda x: x.update(entity))
+
+
+def remove_from_leaderboard(model, entity_key):
+    _change_leaderboard(model, lambda x: x.remove(entity_key.id()))
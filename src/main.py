@@ -23,10 +23,14 @@ import webapp2
 
 from views_base import RobotsTXT, LoaderIO
 from user_views import (MainPage, LiveVote, AddActions, AddThemes,
-						OtherShows, LiveVoteWorker)
+						OtherShows, LiveVoteWorker, LiveVoteBatchWorker,
+						UpvoteWorker)
 from admin_views import (ShowPage, CreateShow, DeleteTools,
-					     JSTestPage, AddPlayers, IntervalTimer)
-from json_views import (ShowJSON, IntervalTimerJSON, UpvoteJSON)
+					     JSTestPage, AddPlayers, IntervalTimer,
+					     VoteResultWorker, DeleteJobWorker)
+from json_views import (ShowJSON, ShowTimelineJSON,
+						UpvoteJSON, ItemsJSON,
+						DeleteJobJSON)
 
 
 config = {'webapp2_extras.sessions': {
@@ -55,10 +59,16 @@ app = webapp2.WSGIApplication([
     (r'/js_test/', JSTestPage),
     # JSON ENDPOINT
     (r'/show_json/(\d+)/', ShowJSON),
-    (r'/interval_timer_json/(\d+)/', IntervalTimerJSON),
+    (r'/show_timeline_json/(\d+)/', ShowTimelineJSON),
     (r'/upvote_json/',UpvoteJSON),
+    (r'/items_json/(action|theme)/', ItemsJSON),
+    (r'/delete_job_json/(\d+)/', DeleteJobJSON),
     # Task Queues
     (r'/live_vote_worker/', LiveVoteWorker),
+    (r'/live_vote_batch_worker/', LiveVoteBatchWorker),
+    (r'/upvote_worker/', UpvoteWorker),
+    (r'/vote_result_worker/', VoteResultWorker),
+    (r'/delete_job_worker/', DeleteJobWorker),
 ],
   config=config,
   debug=True)
@@ -1,11 +1,21 @@
+import bisect
 import datetime
-import math
+import hashlib
+import json
 import random
+import time
 
+import webapp2
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
+from leaderboard import (update_leaderboard, remove_from_leaderboard,
+                         get_leaderboard_keys, get_leaderboard_entities)
+from show_broker import show_broker
 from timezone import (get_mountain_time, back_to_tz, get_today_start,
-                      get_tomorrow_start)
+                      get_tomorrow_start, get_epoch_ms)
 
 VOTE_AFTER_INTERVAL = 25
 DISPLAY_VOTED = 10
@@ -18,20 +28,377 @@ VOTE_OPTIONS = 5
 INCIDENT_AMOUNT = 5
 ACTION_OPTIONS = 3
 RANDOM_ACTION_OPTIONS = 6
+# The options of every test vote, created once as VotingTest fixtures
+TEST_VOTE_OPTIONS = ["I'M JAZZED! START THE SHOW ALREADY!",
+                     "I'm VERY interested in... whatever this is...",
+                     "Present",
+                     "Meh",
+                     "If you notice me sleeping in the audience, try and keep it down. Thanks."]
+# Number of counter shards each live vote option is spread across
+LIVE_VOTE_SHARDS = 20
+# Most live votes stored per transaction, so the votes and a tally shard
+# for each of them stay within the 25 entity groups of a transaction
+LIVE_VOTE_TRANSACTION_SIZE = 12
+# Seconds a show state snapshot is served before it is rebuilt
+SHOW_STATE_TICK = 1
+SHOW_STATE_KEY = 'show-state-%s'
+SHOW_STATE_VERSION_KEY = 'show-state-version-%s'
+SHOW_STATE_LOCK_KEY = 'show-state-lock-%s'
+SHOW_STATE_LOCK_SECONDS = 5
+# Longest a long-polling request is held waiting for a new show state
+SHOW_STATE_LONG_POLL = 25
+# Show state snapshots held in this instance's memory, by show id
+_show_states = {}
+# Seconds the current show is shared across requests
+CURRENT_SHOW_TTL = 10
+CURRENT_SHOW_KEY = 'current-show-%s'
+# Changed whenever an admin changes any show
+SHOWS_VERSION_KEY = 'shows-version'
+# Show properties whose changes have side effects when the show is saved
+SHOW_TRACKED_PROPERTIES = ['theme']
+# Number of counter shards each count of un-used items is spread across
+UNUSED_COUNT_SHARDS = 10
+UNUSED_COUNT_KEY = 'unused-count-%s'
+# Seconds a count rebuilt from the shards is cached, in case an update of
+# the cached count is lost
+UNUSED_COUNT_TTL = 60
+INTERVAL_INDEX_KEY = 'interval-index-%s-%s'
+# Seconds an interval index is kept before it's rebuilt
+INTERVAL_INDEX_TTL = 600
+# Upvotes are added to their item's vote value by tasks on this queue
+UPVOTE_QUEUE = 'upvotes'
+UPVOTE_WORKER_URI = '/upvote_worker/'
+# Most related entities fetched and deleted at once by a delete job
+DELETE_BATCH_SIZE = 200
+# (show version, interval index, expiry time) held in this instance's
+# memory, by show id
+_interval_indexes = {}
 
 
 def show_today():
 	# See if there is a show today, otherwise users aren't allowed to submit actions
-	today_start = get_today_start()
-	tomorrow_start = get_tomorrow_start()
-	return bool(Show.query(Show.scheduled >= today_start,
-						   Show.scheduled < tomorrow_start).get())
+	return bool(get_current_show())
+
+
+def get_request_cache():
+	# Values cached for the length of the current request
+	try:
+		return webapp2.get_request().registry
+	except AssertionError:
+		# Not handling a request, so nothing can be cached
+		return {}
+
+
+def current_show_key():
+	return CURRENT_SHOW_KEY % get_today_start().strftime('%Y-%m-%d')
 
 
 def get_current_show():
-	return Show.query(
-			Show.scheduled >= get_today_start(),
-			Show.scheduled < get_tomorrow_start()).order(-Show.scheduled).get()
+	"""Get the latest show scheduled today.
+
+	The show is resolved once per request, and its id is shared across
+	requests in memcache for a few seconds.
+	"""
+	request_cache = get_request_cache()
+	if 'current_show' in request_cache:
+		return request_cache['current_show']
+	show_id = memcache.get(current_show_key())
+	# Nothing cached, so find today's show
+	if show_id is None:
+		show = Show.query(
+				Show.scheduled >= get_today_start(),
+				Show.scheduled < get_tomorrow_start()).order(-Show.scheduled).get()
+		# Cache 0 when there is no show today
+		show_id = show.key.id() if show else 0
+		memcache.set(current_show_key(), show_id, time=CURRENT_SHOW_TTL)
+	elif show_id:
+		show = ndb.Key(Show, show_id).get()
+	else:
+		show = None
+	request_cache['current_show'] = show
+	return show
+
+
+def get_shows_version():
+	shows_version = memcache.get(SHOWS_VERSION_KEY)
+	if shows_version is None:
+		# Start from the time, so a lost version is never reused
+		memcache.add(SHOWS_VERSION_KEY, int(time.time()))
+		shows_version = memcache.get(SHOWS_VERSION_KEY) or 0
+	return shows_version
+
+
+def invalidate_current_show():
+	get_request_cache().pop('current_show', None)
+	memcache.delete(current_show_key())
+	memcache.incr(SHOWS_VERSION_KEY)
+
+
+def invalidate_show_state(show_id):
+    _show_states.pop(int(show_id), None)
+    memcache.delete(SHOW_STATE_KEY % show_id)
+
+
+def build_show_state(show_id, previous=None):
+    show = ndb.Key(Show, int(show_id)).get()
+    vote_options = show.current_vote_options(show)
+    # Lets clients know when to refetch the show's timeline
+    vote_options['show_version'] = show.version
+    # The countdown changes every second, and clients count it down from
+    # the first state of a vote, so it doesn't make a new version
+    hashed_options = dict([(k, v) for k, v in vote_options.items()
+                           if k != 'voting_length'])
+    etag = hashlib.md5(json.dumps(hashed_options, sort_keys=True)).hexdigest()
+    # Only move to a new version if the state actually changed
+    if previous and previous['etag'] == etag:
+        version = previous['version']
+    else:
+        # Start from the time, so a lost counter never reuses a version
+        version = memcache.incr(SHOW_STATE_VERSION_KEY % show_id,
+                                initial_value=int(time.time()))
+        if version is None:
+            version = int(time.time())
+    vote_options['version'] = version
+    return {'version': version,
+            'etag': etag,
+            'valid_until': time.time() + SHOW_STATE_TICK,
+            'vote_options': vote_options}
+
+
+def get_show_state(show_id):
+    """Get the versioned vote state snapshot of a show.
+
+    Snapshots are kept in instance memory and memcache, and are rebuilt at
+    most once per SHOW_STATE_TICK, or when the show is changed.
+    """
+    show_id = int(show_id)
+    now = time.time()
+    snapshot = _show_states.get(show_id)
+    if snapshot and snapshot['valid_until'] > now:
+        return snapshot
+    snapshot = memcache.get(SHOW_STATE_KEY % show_id)
+    if snapshot and snapshot['valid_until'] > now:
+        _show_states[show_id] = snapshot
+        show_broker.publish(show_id, snapshot['version'])
+        return snapshot
+    # Let a single request rebuild the snapshot, the rest serve the stale one
+    if snapshot and not memcache.add(SHOW_STATE_LOCK_KEY % show_id, True,
+                                     time=SHOW_STATE_LOCK_SECONDS):
+        # Waiters block on the stale version until the rebuild lands
+        show_broker.publish(show_id, snapshot['version'])
+        return snapshot
+    snapshot = build_show_state(show_id, snapshot)
+    memcache.set(SHOW_STATE_KEY % show_id, snapshot)
+    memcache.delete(SHOW_STATE_LOCK_KEY % show_id)
+    _show_states[show_id] = snapshot
+    show_broker.publish(show_id, snapshot['version'])
+    return snapshot
+
+
+def wait_for_show_state(show_id, version, timeout=SHOW_STATE_LONG_POLL):
+    """Long poll for a show state newer than the given version.
+
+    Returns the current snapshot as soon as its version changes, or once
+    the timeout runs out.
+    """
+    show_id = int(show_id)
+    deadline = time.time() + timeout
+    snapshot = get_show_state(show_id)
+    while snapshot['version'] == version and time.time() < deadline:
+        # Wake up on a local publish, or re-check the shared state each tick
+        show_broker.wait(show_id, version,
+                         min(SHOW_STATE_TICK, deadline - time.time()))
+        snapshot = get_show_state(show_id)
+    return snapshot
+
+
+class LiveVoteShard(ndb.Model):
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def get_vote_round(show_key, vote_type, number=None):
+    """Id of a round of voting, which live tallies are kept under.
+
+    number is the interval of an interval vote, or the generation of a test
+    vote. The other vote types have one round per show. Round ids start
+    with the show id.
+    """
+    if vote_type in ['interval', 'test']:
+        return '%s-%s-%s' % (show_key.id(), vote_type, number)
+    return '%s-%s' % (show_key.id(), vote_type)
+
+
+def live_vote_shard_keys(vote_round, entity_key):
+    # Shards are root entities so each one is its own entity group
+    return [ndb.Key(LiveVoteShard, '%s-%s-%s-%s' % (vote_round,
+                                                    entity_key.kind(),
+                                                    entity_key.id(),
+                                                    index))
+            for index in range(0, LIVE_VOTE_SHARDS)]
+
+
+def show_live_vote_shards(show_key):
+    # Query of the live vote shards of every round of a show
+    return LiveVoteShard.query(
+                LiveVoteShard.key >= ndb.Key(LiveVoteShard, '%s-' % show_key.id()),
+                LiveVoteShard.key < ndb.Key(LiveVoteShard, '%s.' % show_key.id()))
+
+
+@ndb.transactional
+def increment_live_vote(vote_round, entity_key, amount=1):
+    """Add live votes to one of an option's shards.
+
+    The shard's read and write run in a transaction, so concurrent votes
+    landing on the same shard don't overwrite each other. Joins any
+    transaction already running, so the increment commits along with it.
+    """
+    # Pick a random shard to spread the writes across entity groups
+    shard_key = random.choice(live_vote_shard_keys(vote_round, entity_key))
+    shard = shard_key.get()
+    if not shard:
+        shard = LiveVoteShard(key=shard_key)
+    shard.count += amount
+    shard.put()
+
+
+def get_live_vote_counts(vote_round, entity_keys):
+    """Sum the live vote shards of each key in a round, in a single batch get."""
+    shard_keys = []
+    for entity_key in entity_keys:
+        shard_keys += live_vote_shard_keys(vote_round, entity_key)
+    shards = ndb.get_multi(shard_keys)
+    counts = {}
+    for i in range(0, len(entity_keys)):
+        key_shards = shards[i * LIVE_VOTE_SHARDS:(i + 1) * LIVE_VOTE_SHARDS]
+        counts[entity_keys[i]] = sum([x.count for x in key_shards if x])
+    return counts
+
+
+def get_live_vote_count(vote_round, entity_key):
+    return get_live_vote_counts(vote_round, [entity_key])[entity_key]
+
+
+class UnusedCountShard(ndb.Model):
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def unused_count_shard_keys(model):
+    # The first shard holds the count the counter was seeded with
+    return [ndb.Key(UnusedCountShard, '%s-%s' % (model._get_kind(), index))
+            for index in range(0, UNUSED_COUNT_SHARDS)]
+
+
+@ndb.transactional
+def change_unused_count(model, amount):
+    """Add to the count of un-used entities of a model.
+
+    Joins any transaction already running, and only touches the cached
+    count once the change is committed.
+    """
+    shard_key = random.choice(unused_count_shard_keys(model)[1:])
+    shard = shard_key.get()
+    if not shard:
+        shard = UnusedCountShard(key=shard_key)
+    shard.count += amount
+    shard.put()
+    count_key = UNUSED_COUNT_KEY % model._get_kind()
+    if amount > 0:
+        cache_change = lambda: memcache.incr(count_key, delta=amount)
+    else:
+        cache_change = lambda: memcache.decr(count_key, delta=-amount)
+    ndb.get_context().call_on_commit(cache_change)
+
+
+def delete_counted(keys):
+    """Delete entities, taking any un-used actions and themes off their
+    counts once the delete has succeeded.
+
+    The actions and themes are loaded in one batch get, and each count
+    changes once per call rather than once per entity.
+    """
+    items = ndb.get_multi([x for x in keys if x.kind() in ['Action', 'Theme']])
+    ndb.delete_multi(keys)
+    unused_counts = {}
+    for item in items:
+        if item and not item.used:
+            unused_counts[type(item)] = unused_counts.get(type(item), 0) + 1
+    for model, amount in unused_counts.items():
+        change_unused_count(model, -amount)
+
+
+@ndb.transactional
+def seed_unused_count(seed_key, count):
+    # Another request may have seeded the counter already
+    seed = seed_key.get()
+    if not seed:
+        seed = UnusedCountShard(key=seed_key, count=count)
+        seed.put()
+    return seed
+
+
+def get_unused_count(model):
+    """Get the count of un-used entities of a model, without a query."""
+    count_key = UNUSED_COUNT_KEY % model._get_kind()
+    count = memcache.get(count_key)
+    if count is None:
+        shards = ndb.get_multi(unused_count_shard_keys(model))
+        changes = sum([x.count for x in shards[1:] if x])
+        seed = shards[0]
+        # Seed the counter from the datastore the first time it is read
+        if not seed:
+            unused = model.query(model.used == False).count()
+            seed = seed_unused_count(unused_count_shard_keys(model)[0],
+                                     unused - changes)
+        count = max(seed.count + changes, 0)
+        memcache.add(count_key, count, time=UNUSED_COUNT_TTL)
+    return count
+
+
+class IntervalIndex(object):
+    """Read only index of a show's intervals.
+
+    A show's intervals don't change once it's created, so the index is
+    cached by the show's version, for up to INTERVAL_INDEX_TTL.
+    """
+    def __init__(self, player_actions):
+        self.intervals = tuple(sorted(set([x.interval for x in player_actions])))
+        # Map of interval to the (PlayerAction key, Player key) of the interval
+        self.player_actions = dict([(x.interval, (x.key, x.player))
+                                    for x in player_actions])
+
+    def get_player_action_key(self, interval):
+        return self.player_actions.get(int(interval), (None, None))[0]
+
+    def get_player_key(self, interval):
+        return self.player_actions.get(int(interval), (None, None))[1]
+
+    def get_position(self, interval):
+        # Position of the interval in the sorted intervals, or None
+        position = bisect.bisect_left(self.intervals, interval)
+        if position < len(self.intervals) and self.intervals[position] == interval:
+            return position
+        return None
+
+    def get_next_interval(self, interval):
+        # If not given an interval, assume the first interval
+        if interval == None:
+            position = 0
+        else:
+            position = self.get_position(interval)
+            if position == None:
+                return None
+            position += 1
+        if position < len(self.intervals):
+            return self.intervals[position]
+        return None
+
+    def get_remaining(self, interval):
+        if interval == None:
+            return len(self.intervals)
+        position = self.get_position(interval)
+        if position == None:
+            return 0
+        return len(self.intervals) - position - 1
 
 
 class Player(ndb.Model):
@@ -43,17 +410,8 @@ class Player(ndb.Model):
     def img_path(self):
         return "/static/img/players/%s" % self.photo_filename
     
-    def get_live_action_vote_exists(self, show, interval, session_id):
-        return bool(LiveActionVote.query(
-                    LiveActionVote.interval == int(interval),
-                    LiveActionVote.show == show,
-                    LiveActionVote.session_id == str(session_id)).get())
-    
     def get_role_vote(self, show, role):
-        return RoleVote.query(
-                    RoleVote.player == self.key,
-                    RoleVote.show == show.key,
-                    RoleVote.role == role).get()
+        return RoleVote.build_key(show.key, self.key, role).get()
 
 
 class Action(ndb.Model):
@@ -61,23 +419,36 @@ class Action(ndb.Model):
     created = ndb.DateProperty(required=True)
     used = ndb.BooleanProperty(default=False)
     vote_value = ndb.IntegerProperty(default=0)
-    live_vote_value = ndb.IntegerProperty(default=0)
     session_id = ndb.StringProperty(required=True)
     
-    def get_live_action_vote_exists(self, show, interval, session_id):
-        return bool(LiveActionVote.query(
-                    LiveActionVote.show == show,
-                    LiveActionVote.session_id == str(session_id)).get())
-    
-    @property
-    def get_voted_sessions(self):
-        avs = ActionVote.query(ActionVote.action == self.key).fetch()
-        return [x.session_id for x in avs]
-        
 
     def put(self, *args, **kwargs):
-        self.created = get_mountain_time()
-        return super(Action, self).put(*args, **kwargs)
+        self.created = get_mountain_time().date()
+        # Count a new un-used action in the same transaction that creates it
+        if not self.key and not self.used:
+            @ndb.transactional(xg=True)
+            def put_counted():
+                action_key = super(Action, self).put(*args, **kwargs)
+                change_unused_count(Action, 1)
+                return action_key
+            action_key = put_counted()
+        else:
+            action_key = super(Action, self).put(*args, **kwargs)
+        # Inside an upvote transaction, only rank the committed vote value
+        ndb.get_context().call_on_commit(lambda: update_leaderboard(self))
+        return action_key
+
+    @ndb.transactional(xg=True)
+    def mark_used(self):
+        # Only write and count the item the first time it is used
+        if not self.used:
+            self.used = True
+            self.put()
+            change_unused_count(Action, -1)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        remove_from_leaderboard(cls, key)
 
 
 class Theme(ndb.Model):
@@ -87,24 +458,56 @@ class Theme(ndb.Model):
     vote_value = ndb.IntegerProperty(default=0)
     session_id = ndb.StringProperty(required=True)
     
-    @property
-    def get_voted_sessions(self):
-        tvs = ThemeVote.query(ThemeVote.theme == self.key).fetch()
-        return [x.session_id for x in tvs]
-    
     def put(self, *args, **kwargs):
         self.created = get_mountain_time()
-        return super(Theme, self).put(*args, **kwargs)
+        # Count a new un-used theme in the same transaction that creates it
+        if not self.key and not self.used:
+            @ndb.transactional(xg=True)
+            def put_counted():
+                theme_key = super(Theme, self).put(*args, **kwargs)
+                change_unused_count(Theme, 1)
+                return theme_key
+            theme_key = put_counted()
+        else:
+            theme_key = super(Theme, self).put(*args, **kwargs)
+        # Inside an upvote transaction, only rank the committed vote value
+        ndb.get_context().call_on_commit(lambda: update_leaderboard(self))
+        return theme_key
+
+    @ndb.transactional(xg=True)
+    def mark_used(self):
+        # Only write and count the item the first time it is used
+        if not self.used:
+            self.used = True
+            self.put()
+            change_unused_count(Theme, -1)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        remove_from_leaderboard(cls, key)
 
 
 class VotingTest(ndb.Model):
     name = ndb.StringProperty(required=True)
-    live_vote_value = ndb.IntegerProperty(default=0)
-    
-    def get_live_test_vote_exists(self, show, session_id):
-        return bool(LiveVotingTest.query(
-                    LiveVotingTest.show == show,
-                    LiveVotingTest.session_id == str(session_id)).get())
+
+
+def voting_test_keys():
+    return [ndb.Key(VotingTest, i + 1) for i in range(0, len(TEST_VOTE_OPTIONS))]
+
+
+def create_voting_tests():
+    """Create any of the test vote option fixtures that don't exist yet."""
+    test_keys = voting_test_keys()
+    tests = ndb.get_multi(test_keys)
+    missing = [VotingTest(key=test_keys[i], name=TEST_VOTE_OPTIONS[i])
+               for i in range(0, len(tests)) if not tests[i]]
+    if missing:
+        ndb.put_multi(missing)
+
+
+def get_voting_tests():
+    # Get the test vote options, created when a test vote is started
+    return [x for x in ndb.get_multi(voting_test_keys()) if x]
 
 
 class Show(ndb.Model):
@@ -123,63 +526,83 @@ class Show(ndb.Model):
     speedup_reached = ndb.BooleanProperty(default=False)
     incident = ndb.KeyProperty(kind=Action)
     test = ndb.KeyProperty(kind=VotingTest)
+    # Generation of the test vote, bumped each time it's started
+    test_round = ndb.IntegerProperty(default=0)
     hero = ndb.KeyProperty(kind=Player)
     villain = ndb.KeyProperty(kind=Player)
     shapeshifter = ndb.KeyProperty(kind=Player)
     lover = ndb.KeyProperty(kind=Player)
     locked = ndb.BooleanProperty(default=False)
+    # Bumped on every save, so clients know when the schedule changed
+    version = ndb.IntegerProperty(default=0)
     
     @property
     def scheduled_tz(self):
         return back_to_tz(self.scheduled)
     
+    def get_vote_round(self, vote_type, interval=None):
+        # The test vote can be re-run, each time as a new round
+        if vote_type == 'test':
+            return get_vote_round(self.key, vote_type, self.test_round)
+        return get_vote_round(self.key, vote_type, interval)
+
     def get_player_action_by_interval(self, interval):
-        for pa in self.player_actions:
-            if pa.interval == int(interval):
-                return pa
+        pa_key = self.interval_index.get_player_action_key(interval)
+        if pa_key:
+            return pa_key.get()
         return None
     
     def get_player_by_interval(self, interval):
-        pa = self.get_player_action_by_interval(interval)
-        if pa:
-            return pa.player
-        else:
-            return None
+        return self.interval_index.get_player_key(interval)
+    
+    @property
+    def interval_index(self):
+        show_id = self.key.id()
+        cached = _interval_indexes.get(show_id)
+        if cached and cached[0] == self.version and cached[2] > time.time():
+            return cached[1]
+        # Editing the show moves it to a new version, and a new index
+        index_key = INTERVAL_INDEX_KEY % (show_id, self.version)
+        index = memcache.get(index_key)
+        if not index:
+            index = IntervalIndex(self.player_actions)
+            memcache.set(index_key, index, time=INTERVAL_INDEX_TTL)
+        _interval_indexes[show_id] = (self.version, index,
+                                      time.time() + INTERVAL_INDEX_TTL)
+        return index
         
     @property
     def players(self):
-        show_players = ShowPlayer.query(ShowPlayer.show == self.key).fetch()
-        return [x.player.get() for x in show_players if getattr(x, 'player', None)]
+        # Loaded once per entity, which only lives for the current request
+        if getattr(self, '_players', None) is None:
+            # Show players are children of the show, so this is consistent
+            show_players = ShowPlayer.query(ancestor=self.key).fetch()
+            # Shows created before that have root show players
+            if not show_players:
+                show_players = ShowPlayer.query(ShowPlayer.show == self.key).fetch()
+            player_keys = [x.player for x in show_players if getattr(x, 'player', None)]
+            self._players = [x for x in ndb.get_multi(player_keys) if x]
+        return self._players
     
     @property
     def player_actions(self):
-        action_intervals = ShowAction.query(ShowAction.show == self.key).fetch()
-        return [x.player_action.get() for x in action_intervals if getattr(x, 'player_action', None) and x.player_action.get()]
+        # Loaded once per entity, which only lives for the current request
+        if getattr(self, '_player_actions', None) is None:
+            # Show actions are children of the show, so this is consistent
+            action_intervals = ShowAction.query(ancestor=self.key).fetch()
+            # Shows created before that have root show actions
+            if not action_intervals:
+                action_intervals = ShowAction.query(ShowAction.show == self.key).fetch()
+            pa_keys = [x.player_action for x in action_intervals if getattr(x, 'player_action', None)]
+            self._player_actions = [x for x in ndb.get_multi(pa_keys) if x]
+        return self._player_actions
     
     @property
     def sorted_intervals(self):
-        return sorted([x.interval for x in self.player_actions])
+        return list(self.interval_index.intervals)
     
     def get_next_interval(self, interval):
-        sorted_intervals = self.sorted_intervals
-        # If given an interval
-        if interval != None:
-            # Loop through the intervals in order
-            for i in range(0, len(sorted_intervals)):
-                if interval == sorted_intervals[i]:
-                    # Get the minutes elapsed between the next interval in the loop
-                    # and the current interval in the loop
-                    try:
-                        return sorted_intervals[i+1]
-                    except IndexError:
-                        return None
-        # Otherwise, assume first interval
-        else:
-            try:
-                return sorted_intervals[0]
-            except IndexError:
-                return None
-        return None
+        return self.interval_index.get_next_interval(interval)
 
     @property
     def is_today(self):
@@ -208,33 +631,39 @@ class Show(ndb.Model):
     
     @property
     def remaining_intervals(self):
-        s_intervals = self.sorted_intervals
-        if self.current_interval == None:
-            return len(s_intervals)
-        try:
-            interval_index = s_intervals.index(self.current_interval)
-        except ValueError:
-            return 0
-        return len(s_intervals[interval_index:]) - 1
+        return self.interval_index.get_remaining(self.current_interval)
+    
+    def get_interval_vote_options(self, show, interval):
+        # Get the stored interval options, by key so they're found right away
+        interval_vote_options = IntervalVoteOptions.build_key(show.key,
+                                                              interval).get()
+        # If the interval options haven't been generated
+        if not interval_vote_options:
+            return []
+        iov_keys = []
+        # Loop through and get the stored interval options
+        for i in range(1, ACTION_OPTIONS + 1):
+            option_key = getattr(interval_vote_options, 'option_' + str(i), None)
+            if option_key:
+                iov_keys.append(option_key)
+        # Convert the keys into actual entities
+        return ndb.get_multi(iov_keys)
     
     def get_randomized_unused_actions(self, show, interval):
-        # Get the stored interval options
-        interval_vote_options = IntervalVoteOptions.query(
-                                    IntervalVoteOptions.show == show.key,
-                                    IntervalVoteOptions.interval == interval).get()
+        unused_actions = self.get_interval_vote_options(show, interval)
         # If the interval options haven't been generated
-        if not interval_vote_options:                    
+        if not unused_actions:
             # Return un-used action keys, sorted by vote
-            unused_keys = Action.query(Action.used == False,
-                                 ).order(-Action.vote_value,
-                                         Action.created).fetch(RANDOM_ACTION_OPTIONS,
-                                                               keys_only=True)
+            unused_keys = get_leaderboard_keys(Action, RANDOM_ACTION_OPTIONS)
             # Get a randomized sample of the top ACTION_OPTIONS amount of action keys
             random_sample_keys = list(random.sample(set(unused_keys),
                                                     min(ACTION_OPTIONS, len(unused_keys))))
             # Convert the keys into actual entities
             unused_actions = ndb.get_multi(random_sample_keys)
-            ivo_create_dict = {'show': show.key, 'interval': interval}
+            ivo_create_dict = {'key': IntervalVoteOptions.build_key(show.key,
+                                                                    interval),
+                               'show': show.key,
+                               'interval': interval}
             # Loop through the randomly select unused actions
             for i in range(0, len(unused_actions)):
                 ivo_option_num = i + 1
@@ -242,23 +671,63 @@ class Show(ndb.Model):
                 ivo_create_dict['option_' + str(ivo_option_num)] = unused_actions[i].key
             # Store the interval options
             IntervalVoteOptions(**ivo_create_dict).put()
-        else:
-            iov_keys = []
-            # Loop through and get the stored interval options
-            for i in range(1, ACTION_OPTIONS + 1):
-                option_key = getattr(interval_vote_options, 'option_' + str(i), None)
-                if option_key:
-                    iov_keys.append(option_key)
-            # Convert the keys into actual entities
-            unused_actions = ndb.get_multi(iov_keys)
-        return unused_actions    
+        return unused_actions
+    
+    def get_incident_vote_options(self, show):
+        # Get the actions stored when the incident vote started
+        incident_vote_options = IncidentVoteOptions.build_key(show.key).get()
+        # If the vote started before its options were stored
+        if not incident_vote_options:
+            return get_leaderboard_entities(Action, INCIDENT_AMOUNT)
+        return [x for x in ndb.get_multi(incident_vote_options.options) if x]
+    
+    def store_incident_vote_options(self, show):
+        # Keep the top actions as the options for the whole incident vote
+        actions = get_leaderboard_entities(Action, INCIDENT_AMOUNT)
+        IncidentVoteOptions(key=IncidentVoteOptions.build_key(show.key),
+                            show=show.key,
+                            options=[x.key for x in actions]).put()
+        return actions
+    
+    @property
+    def vote_timeline(self):
+        """The voting and display phases of every started vote, in epoch
+        milliseconds, so clients can run the countdowns themselves."""
+        timeline = {'server_time': get_epoch_ms(get_mountain_time()),
+                    'version': self.version,
+                    'phases': []}
+        for vote_type in VOTE_TYPES:
+            init_time = getattr(self, "%s_vote_init" % vote_type, None)
+            # If the vote has started
+            if init_time:
+                vote_end = init_time + datetime.timedelta(seconds=VOTE_AFTER_INTERVAL)
+                display_end = vote_end + datetime.timedelta(seconds=DISPLAY_VOTED)
+                timeline['phases'].append({'state': vote_type,
+                                           'voting_start': get_epoch_ms(init_time),
+                                           'voting_end': get_epoch_ms(vote_end),
+                                           'display_end': get_epoch_ms(display_end)})
+        # If there was a recap
+        if self.recap_init:
+            display_end = self.recap_init + datetime.timedelta(seconds=DISPLAY_VOTED)
+            timeline['phases'].append({'state': self.recap_type,
+                                       'recap': True,
+                                       'display_start': get_epoch_ms(self.recap_init),
+                                       'display_end': get_epoch_ms(display_end)})
+        timeline['phases'].sort(key=lambda x: x.get('voting_start',
+                                                    x.get('display_start')))
+        # Add the end of the gap until the next interval
+        interval_gap = self.get_interval_gap(self.current_interval)
+        if interval_gap:
+            gap_end = self.interval_vote_init + datetime.timedelta(minutes=interval_gap)
+            timeline.update({'interval': self.current_interval,
+                             'interval_end': get_epoch_ms(gap_end)})
+        return timeline
     
     @property
     def current_vote_state(self):
         state_dict = {'state': 'default', 'display': 'default', 'used_types': []}
+        # All the vote times are naive mountain times, so compare them as is
         now = get_mountain_time()
-        # Get timezone for comparisons
-        now_tz = back_to_tz(now)
         # Go through all the vote times to see if they've started
         for vote_type in VOTE_TYPES:
             vote_length = VOTE_AFTER_INTERVAL
@@ -266,14 +735,12 @@ class Show(ndb.Model):
             init_time = getattr(self, time_property, None)
             # If the vote has started
             if init_time:
-                # Get the timezone datetime of the start of the vote type
-                init_time_tz = back_to_tz(init_time)
                 # Get the end of the voting period for the type
-                vote_end = init_time_tz + datetime.timedelta(seconds=vote_length)
+                vote_end = init_time + datetime.timedelta(seconds=vote_length)
                 # Get the end of the overall display of the type
                 display_end = vote_end + datetime.timedelta(seconds=DISPLAY_VOTED)
                 # If we're in the voting period of this type
-                if now_tz >= init_time_tz and now_tz <= vote_end:
+                if now >= init_time and now <= vote_end:
                     state_dict.update(
                            {'state': vote_type,
                             'display': 'voting',
@@ -281,8 +748,8 @@ class Show(ndb.Model):
                             'hour': vote_end.hour,
                             'minute': vote_end.minute,
                             'second': vote_end.second,
-                            'voting_length': (vote_end - now_tz).seconds})
-                elif now_tz >= vote_end and now_tz <= display_end:
+                            'voting_length': (vote_end - now).seconds})
+                elif now >= vote_end and now <= display_end:
                     state_dict.update({'state': vote_type,
                                        'display': 'result',
                                        'hour': vote_end.hour,
@@ -290,11 +757,11 @@ class Show(ndb.Model):
                                        'second': vote_end.second})
         # If we're in a recap state
         if self.recap_init:
-            recap_start_tz = back_to_tz(self.recap_init)
+            recap_start = self.recap_init
             # Get the end of the recap display
-            display_end = recap_start_tz + datetime.timedelta(seconds=DISPLAY_VOTED)
+            display_end = recap_start + datetime.timedelta(seconds=DISPLAY_VOTED)
             # If we're in the display period of this recap type
-            if now_tz >= recap_start_tz and now_tz <= display_end:
+            if now >= recap_start and now <= display_end:
                 state_dict.update({'state': self.recap_type,
                                    'display': 'result',
                                    'hour': display_end.hour,
@@ -309,102 +776,128 @@ class Show(ndb.Model):
                     
         return state_dict
 
+    def get_role_candidates(self, show):
+        candidates = []
+        # Loop through all the players in the show
+        for player in show.players:
+            # Make sure the user isn't already the hero/lover/villain
+            if player.key != show.hero and player.key != show.villain \
+                and player.key != show.lover:
+                candidates.append(player)
+        return candidates
+    
+    def get_vote_leader(self, show, vote_type, interval=None):
+        """Get the key of the option currently winning a vote, without
+        storing anything."""
+        vote_round = show.get_vote_round(vote_type, interval)
+        if vote_type == 'test':
+            vts = get_voting_tests()
+            live_counts = get_live_vote_counts(vote_round, [x.key for x in vts])
+            leaders = [x.key for x in vts]
+        elif vote_type == 'incident':
+            actions = self.get_incident_vote_options(show)
+            live_counts = get_live_vote_counts(vote_round, [x.key for x in actions])
+            leaders = [x.key for x in actions]
+        elif vote_type in ROLE_TYPES:
+            players = self.get_role_candidates(show)
+            role_vote_keys = [RoleVote.build_key(show.key, x.key, vote_type)
+                              for x in players]
+            role_counts = get_live_vote_counts(vote_round, role_vote_keys)
+            live_counts = {}
+            for i in range(0, len(players)):
+                live_counts[players[i].key] = role_counts[role_vote_keys[i]]
+            leaders = [x.key for x in players]
+        elif vote_type == 'interval':
+            # Get the actions that were voted on this interval
+            unused_actions = self.get_interval_vote_options(show, interval)
+            live_counts = get_live_vote_counts(vote_round, [x.key for x in unused_actions])
+            leaders = [x.key for x in unused_actions]
+        else:
+            return None
+        if not leaders:
+            return None
+        # Take the option with the most live votes, ties go to the first
+        # option (i.e. the higher pre-show vote for incidents)
+        return max(leaders, key=lambda x: live_counts[x])
+    
+    def finalize_vote(self, vote_type, interval=None):
+        """Store the winner of a finished vote. Safe to run more than once,
+        only the first run stores a result."""
+        player_action_key = None
+        if vote_type == 'interval':
+            player_action = self.get_player_action_by_interval(interval)
+            player_action_key = player_action.key
+        # Queries can't run inside the transaction, so find the winner first
+        voted_key = self.get_vote_leader(self, vote_type, interval)
+        if voted_key:
+            store_vote_result(self.key, vote_type, voted_key, player_action_key)
+            invalidate_show_state(self.key.id())
+
     def current_vote_options(self, show, voting_only=False):
+        """Get the options and counts of the current vote. Read only, the
+        result of a vote is stored by finalize_vote."""
         vote_options = self.current_vote_state.copy()
         state = vote_options.get('state', 'default')
         display = vote_options.get('display')
+        vote_round = show.get_vote_round(state, self.current_interval)
         # If an test has been triggered
         if state == 'test':
             # If we're in the voting phase for the test
             if display == 'voting':
-                vts = VotingTest.query().fetch(ITEM_AMOUNT)
+                vts = get_voting_tests()
+                live_counts = get_live_vote_counts(vote_round, [x.key for x in vts])
                 vote_options['options'] = []
                 for vt in vts:
                     vote_options['options'].append({'name': vt.name,
                                                     'id': vt.key.id(),
-                                                    'count': vt.live_vote_value})
+                                                    'count': live_counts[vt.key]})
             # If we are showing the results of the vote
             elif display == 'result' and not voting_only:
-                # Set the most voted test if it isn't already set
-                if not show.test:
-                    voted_test = VotingTest.query().order(
-                                             -VotingTest.live_vote_value).get()
-                    show.test = voted_test.key
-                    show.put()
-                    voted_test.put()
-                vote_options['voted'] = show.test.get().name
-                vote_options['count'] = show.test.get().live_vote_value
+                # Show the leading test if the result isn't stored yet
+                test = show.test or self.get_vote_leader(show, state)
+                vote_options['voted'] = test.get().name
+                vote_options['count'] = get_live_vote_count(vote_round, test)
         # If an incident has been triggered
         elif state == 'incident':
             # If we're in the voting phase for an incident
             if display == 'voting':
-                actions = Action.query(Action.used == False,
-                          ).order(-Action.vote_value,
-                                  Action.created).fetch(INCIDENT_AMOUNT)
+                actions = self.get_incident_vote_options(show)
+                live_counts = get_live_vote_counts(vote_round, [x.key for x in actions])
                 vote_options['options'] = []
                 for action in actions:
                     vote_options['options'].append({'name': action.description,
                                                     'id': action.key.id(),
-                                                    'count': action.live_vote_value})
+                                                    'count': live_counts[action.key]})
             # If we are showing the results of the vote
             elif display == 'result' and not voting_only:
-                # Set the most voted incident if it isn't already set
-                if not show.incident:
-                    voted_incident = Action.query(Action.used == False,
-                                   ).order(-Action.live_vote_value,
-                                           -Action.vote_value,
-                                           Action.created).get()
-                    show.incident = voted_incident.key
-                    show.put()
-                    # Set the Action as used
-                    voted_incident.used = True
-                    voted_incident.put()
-                vote_options['voted'] = show.incident.get().description
-                vote_options['count'] = show.incident.get().live_vote_value
+                # Show the leading incident if the result isn't stored yet
+                incident = show.incident or self.get_vote_leader(show, state)
+                vote_options['voted'] = incident.get().description
+                vote_options['count'] = get_live_vote_count(vote_round, incident)
         # If a role vote has been triggered
         elif state in ROLE_TYPES:
             vote_options['role'] = True
             # If we're in the voting phase for the role
             if display == 'voting':
                 vote_options['options'] = []
-                # Loop through all the players in the show
-                for player in show.players:
-                    # Make sure the user isn't already the hero/lover/villain
-                    if player.key != show.hero and player.key != show.villain \
-                        and player.key != show.lover:
-                        change_vote = get_or_create_role_vote(show, player, state)
-                        player_dict = {'photo_filename': player.photo_filename,
-                                       'id': player.key.id(),
-                                       'count': change_vote.live_vote_value}
-                        vote_options['options'].append(player_dict)
+                role_players = self.get_role_candidates(show)
+                role_vote_keys = [RoleVote.build_key(show.key, x.key, state)
+                                  for x in role_players]
+                live_counts = get_live_vote_counts(vote_round, role_vote_keys)
+                for i in range(0, len(role_players)):
+                    player_dict = {'photo_filename': role_players[i].photo_filename,
+                                   'id': role_players[i].key.id(),
+                                   'count': live_counts[role_vote_keys[i]]}
+                    vote_options['options'].append(player_dict)
             # If we are showing the results of the vote
             elif display == 'result' and not voting_only:
-                role_player = getattr(show, state, None)
-                # Set the role if it isn't already set
-                if not role_player:
-                    role_votes = RoleVote.query(RoleVote.role == state,
-                                                RoleVote.show == show.key,
-                                     ).order(-RoleVote.live_vote_value).fetch()
-                    # Grab the first player
-                    for rv in role_votes:
-                        # Make sure they aren't already the hero/villain/lover
-                        if rv.player != show.hero and rv.player != show.villain \
-                            and rv.player != show.lover:
-                            # We've found the voted role, break out of the loop
-                            voted_role = rv
-                            break
-                    # Setting role for the show
-                    setattr(show, state, voted_role.player)
-                    show.put()
-                    # Getting the player selected for the role
-                    role_player = voted_role.player
-                else:
-                    voted_role = RoleVote.query(RoleVote.role == state,
-                                                RoleVote.show == show.key,
-                                                RoleVote.player == role_player).get()
+                # Show the leading player if the role isn't stored yet
+                role_player = getattr(show, state, None) or \
+                                self.get_vote_leader(show, state)
+                voted_role = RoleVote.build_key(show.key, role_player, state)
                 vote_options['voted'] = state.title()
                 vote_options['photo_filename'] = role_player.get().photo_filename
-                vote_options['count'] = voted_role.live_vote_value
+                vote_options['count'] = get_live_vote_count(vote_round, voted_role)
         # If an interval has been triggered
         elif state == 'interval':
             interval = self.current_interval
@@ -422,52 +915,62 @@ class Show(ndb.Model):
                 vote_options['speedup'] = True
             # If we're in the voting phase for the interval
             if display == 'voting':
-                unused_actions = self.get_randomized_unused_actions(show, interval)
+                unused_actions = self.get_interval_vote_options(show, interval)
+                live_counts = get_live_vote_counts(vote_round, [x.key for x in unused_actions])
                 vote_options['options'] = []
                 for i in range(0, ACTION_OPTIONS):
                     try:
                         vote_options['options'].append({
                                             'name': unused_actions[i].description,
                                             'id': unused_actions[i].key.id(),
-                                            'count': unused_actions[i].live_vote_value})
+                                            'count': live_counts[unused_actions[i].key]})
                     except IndexError:
                         pass
             # If we are showing the results of the vote
             elif display == 'result' and not voting_only:
-                # If an action wasn't already chosen for this interval
-                if not player_action.action:
-                    voted_action = None
-                    # Get the actions that were voted on this interval
-                    unused_actions = self.get_randomized_unused_actions(show, interval)
-                    # Take the action with the highest live_vote_value
-                    # Or just default to the first action
-                    for action in unused_actions:
-                        if voted_action == None:
-                            voted_action = action
-                        elif action.live_vote_value > voted_action.live_vote_value:
-                            voted_action = action
-                    # If a voted action exists
-                    if voted_action:
-                        # Set the player action
-                        player_action.action = voted_action.key
-                        player_action.put()
-                        # Set the action as used
-                        voted_action.used = True
-                        voted_action.put()
-                        vote_options.update({'voted': voted_action.description,
-                                             'count': voted_action.live_vote_value})
-                else:
-                    vote_options.update({'voted': player_action.action.get().description,
-                                         'count': player_action.action.get().live_vote_value})
+                # Show the leading action if the result isn't stored yet
+                voted_action = player_action.action or \
+                                self.get_vote_leader(show, state, interval)
+                # If a voted action exists
+                if voted_action:
+                    vote_options.update({'voted': voted_action.get().description,
+                                         'count': get_live_vote_count(vote_round,
+                                                                      voted_action)})
         return vote_options
     
+    @classmethod
+    def _from_pb(cls, pb, set_key=True, ent=None, key=None):
+        show = super(Show, cls)._from_pb(pb, set_key, ent, key)
+        # Remember the stored values, so put can tell what changed
+        show._stored_values = show.get_tracked_values()
+        return show
+
+    def get_tracked_values(self):
+        return dict([(x, getattr(self, x)) for x in SHOW_TRACKED_PROPERTIES])
+
+    def has_changed(self, name):
+        """Whether a property changed since the show was loaded or saved.
+
+        Every property of a show that was never saved counts as changed.
+        """
+        stored_values = getattr(self, '_stored_values', {})
+        return name not in stored_values or \
+                stored_values[name] != getattr(self, name)
+
     def put(self, *args, **kwargs):
-        # If a theme was specified, set the theme as used
-        if self.theme:
-            theme_entity = self.theme.get()
-            theme_entity.used = True
-            theme_entity.put()
-        return super(Show, self).put(*args, **kwargs)
+        self.version = (self.version or 0) + 1
+        # If the theme changed, set the new theme as used along with the show
+        if self.theme and self.has_changed('theme'):
+            @ndb.transactional(xg=True)
+            def put_with_theme():
+                self.theme.get().mark_used()
+                return super(Show, self).put(*args, **kwargs)
+            show_key = put_with_theme()
+        else:
+            show_key = super(Show, self).put(*args, **kwargs)
+        self._stored_values = self.get_tracked_values()
+        invalidate_show_state(show_key.id())
+        return show_key
 
 
 class ShowPlayer(ndb.Model):
@@ -478,12 +981,16 @@ class ShowPlayer(ndb.Model):
 class ActionVote(ndb.Model):
     action = ndb.KeyProperty(kind=Action, required=True)
     session_id = ndb.StringProperty(required=True)
-    
-    def put(self, *args, **kwargs):
-        action = Action.query(Action.key == self.action).get()
-        action.vote_value += 1
-        action.put()
-        return super(ActionVote, self).put(*args, **kwargs)
+    # Whether the vote was added to the action's vote value
+    counted = ndb.BooleanProperty(default=False, indexed=False)
+
+    @classmethod
+    def build_key(cls, action_key, session_id):
+        return ndb.Key(cls, '%s-%s' % (action_key.id(), session_id))
+
+    @property
+    def item(self):
+        return self.action
 
 
 class LiveActionVote(ndb.Model):
@@ -494,10 +1001,19 @@ class LiveActionVote(ndb.Model):
     session_id = ndb.StringProperty(required=True)
     created = ndb.DateProperty(required=True)
 
+    @classmethod
+    def build_key(cls, show_key, interval, session_id):
+        return ndb.Key(cls, '%s-%s-%s' % (show_key.id(), interval, session_id))
+
+    @property
+    def vote_round(self):
+        # Incident votes are stored with an interval of -1
+        if self.interval == -1:
+            return get_vote_round(self.show, 'incident')
+        return get_vote_round(self.show, 'interval', self.interval)
+
     def put(self, *args, **kwargs):
-        action = Action.query(Action.key == self.action).get()
-        action.live_vote_value += 1
-        action.put()
+        increment_live_vote(self.vote_round, self.action)
         return super(LiveActionVote, self).put(*args, **kwargs)
 
 
@@ -515,48 +1031,191 @@ class ShowAction(ndb.Model):
 class ThemeVote(ndb.Model):
     theme = ndb.KeyProperty(kind=Theme, required=True)
     session_id = ndb.StringProperty(required=True)
+    # Whether the vote was added to the theme's vote value
+    counted = ndb.BooleanProperty(default=False, indexed=False)
 
-    def put(self, *args, **kwargs):
-        theme = Theme.query(Theme.key == self.theme).get()
-        theme.vote_value += 1
-        theme.put()
-        return super(ThemeVote, self).put(*args, **kwargs)
+    @classmethod
+    def build_key(cls, theme_key, session_id):
+        return ndb.Key(cls, '%s-%s' % (theme_key.id(), session_id))
+
+    @property
+    def item(self):
+        return self.theme
+
+
+def insert_upvote(item_key, vote):
+    """Store an upvote, and queue adding it to the item's vote value.
+
+    Upvotes are keyed by item and session, so a repeated upvote finds the
+    existing vote and is dropped. Each vote is its own entity group, so
+    storing it never collides with other voters. The task adding it to the
+    vote value is queued in the same transaction, and is retried when
+    upvotes of a popular item collide. Returns False if the vote wasn't
+    stored.
+    """
+    # The item may have been deleted
+    if not item_key.get():
+        return False
+    @ndb.transactional
+    def insert():
+        if vote.key.get():
+            return False
+        vote.put()
+        taskqueue.add(url=UPVOTE_WORKER_URI,
+                      params={'vote_key': vote.key.urlsafe()},
+                      queue_name=UPVOTE_QUEUE,
+                      transactional=True)
+        return True
+    return insert()
+
+
+@ndb.transactional(xg=True)
+def count_upvote(vote_key):
+    """Add a stored upvote to its item's vote value, only once."""
+    vote = vote_key.get()
+    if not vote or vote.counted:
+        return
+    item = vote.item.get()
+    if item:
+        item.vote_value += 1
+        item.put()
+    vote.counted = True
+    vote.put()
+
+
+def get_voted_ids(vote_model, items, session_id):
+    """Ids of the items a session has upvoted, in one batch key get."""
+    vote_keys = [vote_model.build_key(item.key, session_id) for item in items]
+    return [item.key.id() for item, vote in zip(items, ndb.get_multi(vote_keys))
+            if vote]
 
 
 class LiveVotingTest(ndb.Model):
     test = ndb.KeyProperty(kind=VotingTest, required=True)
     show = ndb.KeyProperty(kind=Show, required=True)
+    test_round = ndb.IntegerProperty(default=0)
     session_id = ndb.StringProperty(required=True)
 
+    @classmethod
+    def build_key(cls, show_key, test_round, session_id):
+        return ndb.Key(cls, '%s-%s-%s' % (show_key.id(), test_round, session_id))
+
     def put(self, *args, **kwargs):
-        vt = VotingTest.query(VotingTest.key == self.test).get()
-        vt.live_vote_value += 1
-        vt.put()
+        increment_live_vote(get_vote_round(self.show, 'test', self.test_round),
+                            self.test)
         return super(LiveVotingTest, self).put(*args, **kwargs)
 
 
+@ndb.transactional(xg=True)
+def create_show(show, player_keys, interval_players):
+    """Save a new show along with its players and action intervals.
+
+    interval_players is a list of (interval, player key) pairs. Everything
+    created is a child of the show, so the show, its theme and all of its
+    related entities are written in one transaction.
+    """
+    show.key = ndb.Key(Show, Show.allocate_ids(1)[0])
+    entities = [ShowPlayer(parent=show.key, show=show.key, player=x)
+                for x in player_keys]
+    if interval_players:
+        first_id = PlayerAction.allocate_ids(len(interval_players),
+                                             parent=show.key)[0]
+        for i in range(0, len(interval_players)):
+            interval, player_key = interval_players[i]
+            player_action_key = ndb.Key(PlayerAction, first_id + i,
+                                        parent=show.key)
+            entities.append(PlayerAction(key=player_action_key,
+                                         interval=interval,
+                                         player=player_key))
+            entities.append(ShowAction(parent=show.key,
+                                       show=show.key,
+                                       player_action=player_action_key))
+    show.put()
+    ndb.put_multi(entities)
+    return show.key
+
+
+@ndb.transactional(xg=True)
+def store_vote_result(show_key, vote_type, voted_key, player_action_key=None):
+    # Interval results are stored on the interval's player action
+    if vote_type == 'interval':
+        player_action = player_action_key.get()
+        # If an action was already chosen for this interval
+        if player_action.action:
+            return
+        player_action.action = voted_key
+        player_action.put()
+    else:
+        show = show_key.get()
+        # If the result was already stored
+        if getattr(show, vote_type, None):
+            return
+        setattr(show, vote_type, voted_key)
+        show.put()
+    # Set the voted action as used
+    if vote_type in ['interval', 'incident']:
+        voted_key.get().mark_used()
+
+
+@ndb.transactional(xg=True)
+def insert_live_vote(live_vote):
+    """Store a live vote unless its key already exists.
+
+    Live votes have deterministic keys, so a retried task or a double
+    tapped vote finds the existing vote and is dropped. The put() override
+    of each live vote kind increments its tally, which joins this
+    transaction, so the vote and its tally increment are committed
+    together.
+    """
+    if live_vote.key.get():
+        return False
+    live_vote.put()
+    return True
+
+
+@ndb.transactional(xg=True)
+def insert_live_votes(tallied_votes):
+    """Store a batch of live votes that don't exist yet, with their tallies.
+
+    tallied_votes is a list of (live vote, vote round, option key). Every
+    vote and tally shard is its own entity group, so a batch can hold at
+    most LIVE_VOTE_TRANSACTION_SIZE votes. The existence check, the votes
+    and their tally increments are committed together, so a retried or
+    overlapping batch can't count a vote twice or lose its tally.
+    """
+    existing = ndb.get_multi([x[0].key for x in tallied_votes])
+    new_votes = []
+    option_counts = {}
+    for (live_vote, vote_round, option_key), found in zip(tallied_votes,
+                                                          existing):
+        if not found:
+            new_votes.append(live_vote)
+            tally = (vote_round, option_key)
+            option_counts[tally] = option_counts.get(tally, 0) + 1
+    # put_multi skips the per-vote put overrides, so the tallies are
+    # incremented once per option below
+    ndb.put_multi(new_votes)
+    for (vote_round, option_key), count in option_counts.items():
+        increment_live_vote(vote_round, option_key, count)
+    return len(new_votes)
+
+
 def get_or_create_role_vote(show, player, role):
-    role_vote = RoleVote.query(RoleVote.show == show.key,
-                               RoleVote.player == player.key,
-                               RoleVote.role == role).get()
-    if not role_vote:
-        role_vote = RoleVote(show=show.key,
-                             player=player.key,
-                             role=role).put().get()
-    return role_vote
+    role_vote_key = RoleVote.build_key(show.key, player.key, role)
+    return RoleVote.get_or_insert(role_vote_key.id(),
+                                  show=show.key,
+                                  player=player.key,
+                                  role=role)
 
 
 class RoleVote(ndb.Model):
     show = ndb.KeyProperty(kind=Show, required=True)
     player = ndb.KeyProperty(kind=Player, required=True)
     role = ndb.StringProperty(required=True, choices=ROLE_TYPES)
-    live_vote_value = ndb.IntegerProperty(default=0)
 
-    def get_live_role_vote_exists(self, show, role, session_id):
-        return bool(LiveRoleVote.query(
-                    LiveRoleVote.show == show,
-                    LiveRoleVote.role == role,
-                    LiveRoleVote.session_id == str(session_id)).get())
+    @classmethod
+    def build_key(cls, show_key, player_key, role):
+        return ndb.Key(cls, '%s-%s-%s' % (show_key.id(), role, player_key.id()))
 
 
 class LiveRoleVote(ndb.Model):
@@ -565,12 +1224,13 @@ class LiveRoleVote(ndb.Model):
     role = ndb.StringProperty(required=True, choices=ROLE_TYPES)
     session_id = ndb.StringProperty(required=True)
 
+    @classmethod
+    def build_key(cls, show_key, role, session_id):
+        return ndb.Key(cls, '%s-%s-%s' % (show_key.id(), role, session_id))
+
     def put(self, *args, **kwargs):
-        role_vote = RoleVote.query(RoleVote.show == self.show,
-                                   RoleVote.player == self.player,
-                                   RoleVote.role == self.role).get()
-        role_vote.live_vote_value += 1
-        role_vote.put()
+        increment_live_vote(get_vote_round(self.show, self.role),
+                            RoleVote.build_key(self.show, self.player, self.role))
         return super(LiveRoleVote, self).put(*args, **kwargs)
 
 class IntervalVoteOptions(ndb.Model):
@@ -579,3 +1239,127 @@ class IntervalVoteOptions(ndb.Model):
     option_1 = ndb.KeyProperty(kind=Action)
     option_2 = ndb.KeyProperty(kind=Action)
     option_3 = ndb.KeyProperty(kind=Action)
+
+    @classmethod
+    def build_key(cls, show_key, interval):
+        return ndb.Key(cls, '%s-%s' % (show_key.id(), interval))
+
+
+class IncidentVoteOptions(ndb.Model):
+    show = ndb.KeyProperty(kind=Show, required=True)
+    options = ndb.KeyProperty(kind=Action, repeated=True)
+
+    @classmethod
+    def build_key(cls, show_key):
+        return ndb.Key(cls, show_key.id())
+
+
+class DeleteJob(ndb.Model):
+    """Deletes entities, and everything related to them, in batches.
+
+    targets holds the keys still to be deleted. The related entities of the
+    first target are paged through stage by stage, with cursor marking the
+    position in the current stage. When deleting every un-used action, the
+    next page of them only becomes the targets once the targets run out,
+    with unused_cursor marking the position in the un-used actions.
+    """
+    description = ndb.StringProperty(required=True)
+    targets = ndb.KeyProperty(repeated=True, indexed=False)
+    total = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.IntegerProperty(default=0, indexed=False)
+    deleted = ndb.IntegerProperty(default=0, indexed=False)
+    # Still paging through every un-used action
+    find_unused = ndb.BooleanProperty(default=False, indexed=False)
+    unused_cursor = ndb.StringProperty(indexed=False)
+    stage = ndb.IntegerProperty(default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    @property
+    def progress(self):
+        return {'id': self.key.id(),
+                'description': self.description,
+                'total': self.total,
+                'done': self.done,
+                'deleted': self.deleted,
+                'finished': bool(self.finished)}
+
+    def get_cursor(self, urlsafe):
+        if urlsafe:
+            return Cursor(urlsafe=urlsafe)
+        return None
+
+    def run_step(self):
+        """Delete the next batch of entities, returns False when finished."""
+        # Only hold one page of the un-used actions at a time
+        if self.find_unused and not self.targets:
+            unused_query = Action.query(Action.used == False)
+            keys, cursor, more = unused_query.fetch_page(
+                                    DELETE_BATCH_SIZE, keys_only=True,
+                                    start_cursor=self.get_cursor(self.unused_cursor))
+            self.targets = keys
+            self.total += len(keys)
+            self.find_unused = bool(more and keys)
+            self.unused_cursor = cursor.urlsafe() if self.find_unused else None
+        elif self.targets:
+            target = self.targets[0]
+            stages = get_cascade_stages(target)
+            # Delete a page of the entities related to the target
+            if self.stage < len(stages):
+                keys, cursor, more = stages[self.stage].fetch_page(
+                                        DELETE_BATCH_SIZE, keys_only=True,
+                                        start_cursor=self.get_cursor(self.cursor))
+                delete_keys = keys + get_cascade_keys(keys)
+                if more and keys:
+                    self.cursor = cursor.urlsafe()
+                else:
+                    self.stage += 1
+                    self.cursor = None
+            # Then the target itself
+            else:
+                delete_keys = [target]
+                if target.kind() == 'Show':
+                    show = target.get()
+                    # Delete the theme used in the show, if it existed
+                    if show and show.theme:
+                        delete_keys.append(show.theme)
+                    # Today's show may be deleted
+                    invalidate_current_show()
+                self.targets.pop(0)
+                self.stage = 0
+                self.done += 1
+            delete_counted(delete_keys)
+            self.deleted += len(delete_keys)
+        if not self.find_unused and not self.targets:
+            self.finished = datetime.datetime.utcnow()
+        return not self.finished
+
+
+def get_cascade_stages(key):
+    """Queries of the entities deleted along with an entity, in order."""
+    if key.kind() == 'Action':
+        return [ActionVote.query(ActionVote.action == key)]
+    elif key.kind() == 'Theme':
+        return [ThemeVote.query(ThemeVote.theme == key)]
+    elif key.kind() == 'Show':
+        return [ShowAction.query(ShowAction.show == key),
+                ShowPlayer.query(ShowPlayer.show == key),
+                RoleVote.query(RoleVote.show == key),
+                show_live_vote_shards(key)]
+    return []
+
+
+def get_cascade_keys(keys):
+    """Keys of the entities deleted along with a batch from a stage."""
+    cascade_keys = []
+    if keys and keys[0].kind() == 'ShowAction':
+        # The player actions of the show, and the actions voted for them
+        player_action_keys = [x.player_action for x in ndb.get_multi(keys) if x]
+        for player_action in ndb.get_multi(player_action_keys):
+            if player_action:
+                cascade_keys.append(player_action.key)
+                if player_action.action:
+                    cascade_keys.append(player_action.action)
+    return cascade_keys
+
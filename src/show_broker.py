@@ -0,0 +1,32 @@
+import threading
+
+
+class LocalShowBroker(object):
+    """In-process stand-in for a push channel between show state changes and
+    the requests long-polling for them.
+
+    Waiting requests are woken as soon as this instance publishes a new
+    version of a show's state. Changes made on other instances are picked
+    up by the waiters re-checking the shared state once their wait times out.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+
+    def publish(self, show_id, version):
+        with self._condition:
+            # If this version was already published
+            if self._versions.get(show_id) == version:
+                return
+            self._versions[show_id] = version
+            self._condition.notify_all()
+
+    def wait(self, show_id, version, timeout):
+        with self._condition:
+            # Only wait if a newer version hasn't been published already
+            if self._versions.get(show_id, version) == version:
+                self._condition.wait(timeout)
+        return self._versions.get(show_id)
+
+
+show_broker = LocalShowBroker()
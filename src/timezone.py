@@ -1,42 +1,89 @@
+import calendar
 import datetime
-import time
-from pytz.gae import pytz
-
-
-class Mountain_tzinfo(datetime.tzinfo):
-    """Implementation of the Pacific timezone."""
-    def utcoffset(self, dt):
-        return datetime.timedelta(hours=-7) + self.dst(dt)
-
-    def _FirstSunday(self, dt):
-        """First Sunday on or after dt."""
-        return dt + datetime.timedelta(days=(6-dt.weekday()))
-
-    def dst(self, dt):
-        # 2 am on the second Sunday in March
-        dst_start = self._FirstSunday(datetime.datetime(dt.year, 3, 8, 2))
-        # 1 am on the first Sunday in November
-        dst_end = self._FirstSunday(datetime.datetime(dt.year, 11, 1, 1))
-
-        if dst_start <= dt.replace(tzinfo=None) < dst_end:
-            return datetime.timedelta(hours=1)
-        else:
-            return datetime.timedelta(hours=0)
-    def tzname(self, dt):
-        if self.dst(dt) == datetime.timedelta(hours=0):
-            return "MST"
-        else:
-            return "MDT"
+
+from pytz.tzinfo import DstTzInfo, memorized_datetime, memorized_ttinfo
+
+# Offsets of Mountain standard and daylight saving time from UTC
+MST_OFFSET = datetime.timedelta(hours=-7)
+MDT_OFFSET = datetime.timedelta(hours=-6)
+# UTC start and end of daylight saving time, by year
+_dst_transitions = {}
+# Time zones built from tz_tables, by name
+_zones = {}
+# Gets the current UTC time, replaceable to fix the time
+_utc_clock = datetime.datetime.utcnow
+
+
+def _first_sunday(dt):
+	"""First Sunday on or after dt."""
+	return dt + datetime.timedelta(days=(6 - dt.weekday()))
+
+
+def get_dst_transitions(year):
+	"""Get the UTC times daylight saving time starts and ends in a year."""
+	transitions = _dst_transitions.get(year)
+	if not transitions:
+		# 2 am MST on the second Sunday in March
+		dst_start = _first_sunday(datetime.datetime(year, 3, 8, 2)) - MST_OFFSET
+		# 2 am MDT on the first Sunday in November
+		dst_end = _first_sunday(datetime.datetime(year, 11, 1, 2)) - MDT_OFFSET
+		transitions = _dst_transitions[year] = (dst_start, dst_end)
+	return transitions
+
+
+def utc_to_mountain(utc_time):
+	"""Convert a naive UTC time to a naive mountain time."""
+	dst_start, dst_end = get_dst_transitions(utc_time.year)
+	if dst_start <= utc_time < dst_end:
+		return utc_time + MDT_OFFSET
+	return utc_time + MST_OFFSET
+
+
+def mountain_to_utc(mountain_time):
+	"""Convert a naive mountain time to a naive UTC time.
+
+	The hour repeated when daylight saving time ends is taken as daylight
+	saving time.
+	"""
+	dst_start, dst_end = get_dst_transitions(mountain_time.year)
+	utc_time = mountain_time - MDT_OFFSET
+	if dst_start <= utc_time < dst_end:
+		return utc_time
+	return mountain_time - MST_OFFSET
+
+
+def set_utc_clock(clock=None):
+	# Replace the function giving the current UTC time, or restore it
+	global _utc_clock
+	_utc_clock = clock or datetime.datetime.utcnow
+
 
 def get_mountain_time():
-	mountain_time = datetime.datetime.fromtimestamp(
-				time.mktime(datetime.datetime.utcnow().timetuple()), Mountain_tzinfo())
-	return mountain_time.replace(tzinfo=None)
+	return utc_to_mountain(_utc_clock())
+
+
+def get_zone(name):
+	"""Get a pytz time zone, built from its bundled table on first use."""
+	zone = _zones.get(name)
+	if zone is None:
+		# Only load the tables once a zone is needed
+		from tz_tables import TABLES
+		transitions = [datetime.datetime.min]
+		transition_info = []
+		for transition, utcoffset, dst, tzname in TABLES[name]:
+			if transition is not None:
+				transitions.append(memorized_datetime(transition))
+			transition_info.append(memorized_ttinfo(utcoffset, dst, tzname))
+		zone_class = type(str(name), (DstTzInfo,), {
+							'zone': name,
+							'_utc_transition_times': transitions,
+							'_transition_info': transition_info})
+		zone = _zones[name] = zone_class()
+	return zone
 
 
 def back_to_tz(date_time):
-	denver_tz = pytz.timezone('America/Denver')
-	return denver_tz.localize(date_time, is_dst=None)
+	return get_zone('America/Denver').localize(date_time, is_dst=None)
 
 
 def get_today_start():
@@ -48,3 +95,10 @@ def get_tomorrow_start():
 	today = get_mountain_time().date()
 	tomorrow = today + datetime.timedelta(1)
 	return datetime.datetime.fromordinal(tomorrow.toordinal())
+
+
+def get_epoch_ms(date_time):
+	# Milliseconds since the epoch of a mountain time
+	utc_time = mountain_to_utc(date_time)
+	return (calendar.timegm(utc_time.timetuple()) * 1000 +
+			utc_time.microsecond / 1000)
@@ -0,0 +1,171 @@
+"""Time zone transitions, compiled from pytz's zoneinfo.zip.
+
+Generated by tools/build_tz_tables.py, don't edit by hand. Each row is the
+UTC epoch second the transition happens (None for the first), followed by
+the utc offset and daylight saving offset in seconds, and the zone name.
+"""
+
+OLSON_VERSION = '2010h'
+
+TABLES = {
+    'America/Denver': (
+        (None, -25200, 0, 'MST'),
+        (-1633273200, -21600, 3600, 'MDT'),
+        (-1615132800, -25200, 0, 'MST'),
+        (-1601823600, -21600, 3600, 'MDT'),
+        (-1583683200, -25200, 0, 'MST'),
+        (-1570374000, -21600, 3600, 'MDT'),
+        (-1551628800, -25200, 0, 'MST'),
+        (-1538924400, -21600, 3600, 'MDT'),
+        (-1534089600, -25200, 0, 'MST'),
+        (-880210800, -21600, 3600, 'MWT'),
+        (-769395600, -21600, 3600, 'MPT'),
+        (-765388800, -25200, 0, 'MST'),
+        (-147884400, -21600, 3600, 'MDT'),
+        (-131558400, -25200, 0, 'MST'),
+        (-116434800, -21600, 3600, 'MDT'),
+        (-100108800, -25200, 0, 'MST'),
+        (-84380400, -21600, 3600, 'MDT'),
+        (-68659200, -25200, 0, 'MST'),
+        (-52930800, -21600, 3600, 'MDT'),
+        (-37209600, -25200, 0, 'MST'),
+        (-21481200, -21600, 3600, 'MDT'),
+        (-5760000, -25200, 0, 'MST'),
+        (9968400, -21600, 3600, 'MDT'),
+        (25689600, -25200, 0, 'MST'),
+        (41418000, -21600, 3600, 'MDT'),
+        (57744000, -25200, 0, 'MST'),
+        (73472400, -21600, 3600, 'MDT'),
+        (89193600, -25200, 0, 'MST'),
+        (104922000, -21600, 3600, 'MDT'),
+        (120643200, -25200, 0, 'MST'),
+        (126694800, -21600, 3600, 'MDT'),
+        (152092800, -25200, 0, 'MST'),
+        (162378000, -21600, 3600, 'MDT'),
+        (183542400, -25200, 0, 'MST'),
+        (199270800, -21600, 3600, 'MDT'),
+        (215596800, -25200, 0, 'MST'),
+        (230720400, -21600, 3600, 'MDT'),
+        (247046400, -25200, 0, 'MST'),
+        (262774800, -21600, 3600, 'MDT'),
+        (278496000, -25200, 0, 'MST'),
+        (294224400, -21600, 3600, 'MDT'),
+        (309945600, -25200, 0, 'MST'),
+        (325674000, -21600, 3600, 'MDT'),
+        (341395200, -25200, 0, 'MST'),
+        (357123600, -21600, 3600, 'MDT'),
+        (372844800, -25200, 0, 'MST'),
+        (388573200, -21600, 3600, 'MDT'),
+        (404899200, -25200, 0, 'MST'),
+        (420022800, -21600, 3600, 'MDT'),
+        (436348800, -25200, 0, 'MST'),
+        (452077200, -21600, 3600, 'MDT'),
+        (467798400, -25200, 0, 'MST'),
+        (483526800, -21600, 3600, 'MDT'),
+        (499248000, -25200, 0, 'MST'),
+        (514976400, -21600, 3600, 'MDT'),
+        (530697600, -25200, 0, 'MST'),
+        (544611600, -21600, 3600, 'MDT'),
+        (562147200, -25200, 0, 'MST'),
+        (576061200, -21600, 3600, 'MDT'),
+        (594201600, -25200, 0, 'MST'),
+        (607510800, -21600, 3600, 'MDT'),
+        (625651200, -25200, 0, 'MST'),
+        (638960400, -21600, 3600, 'MDT'),
+        (657100800, -25200, 0, 'MST'),
+        (671014800, -21600, 3600, 'MDT'),
+        (688550400, -25200, 0, 'MST'),
+        (702464400, -21600, 3600, 'MDT'),
+        (720000000, -25200, 0, 'MST'),
+        (733914000, -21600, 3600, 'MDT'),
+        (752054400, -25200, 0, 'MST'),
+        (765363600, -21600, 3600, 'MDT'),
+        (783504000, -25200, 0, 'MST'),
+        (796813200, -21600, 3600, 'MDT'),
+        (814953600, -25200, 0, 'MST'),
+        (828867600, -21600, 3600, 'MDT'),
+        (846403200, -25200, 0, 'MST'),
+        (860317200, -21600, 3600, 'MDT'),
+        (877852800, -25200, 0, 'MST'),
+        (891766800, -21600, 3600, 'MDT'),
+        (909302400, -25200, 0, 'MST'),
+        (923216400, -21600, 3600, 'MDT'),
+        (941356800, -25200, 0, 'MST'),
+        (954666000, -21600, 3600, 'MDT'),
+        (972806400, -25200, 0, 'MST'),
+        (986115600, -21600, 3600, 'MDT'),
+        (1004256000, -25200, 0, 'MST'),
+        (1018170000, -21600, 3600, 'MDT'),
+        (1035705600, -25200, 0, 'MST'),
+        (1049619600, -21600, 3600, 'MDT'),
+        (1067155200, -25200, 0, 'MST'),
+        (1081069200, -21600, 3600, 'MDT'),
+        (1099209600, -25200, 0, 'MST'),
+        (1112518800, -21600, 3600, 'MDT'),
+        (1130659200, -25200, 0, 'MST'),
+        (1143968400, -21600, 3600, 'MDT'),
+        (1162108800, -25200, 0, 'MST'),
+        (1173603600, -21600, 3600, 'MDT'),
+        (1194163200, -25200, 0, 'MST'),
+        (1205053200, -21600, 3600, 'MDT'),
+        (1225612800, -25200, 0, 'MST'),
+        (1236502800, -21600, 3600, 'MDT'),
+        (1257062400, -25200, 0, 'MST'),
+        (1268557200, -21600, 3600, 'MDT'),
+        (1289116800, -25200, 0, 'MST'),
+        (1300006800, -21600, 3600, 'MDT'),
+        (1320566400, -25200, 0, 'MST'),
+        (1331456400, -21600, 3600, 'MDT'),
+        (1352016000, -25200, 0, 'MST'),
+        (1362906000, -21600, 3600, 'MDT'),
+        (1383465600, -25200, 0, 'MST'),
+        (1394355600, -21600, 3600, 'MDT'),
+        (1414915200, -25200, 0, 'MST'),
+        (1425805200, -21600, 3600, 'MDT'),
+        (1446364800, -25200, 0, 'MST'),
+        (1457859600, -21600, 3600, 'MDT'),
+        (1478419200, -25200, 0, 'MST'),
+        (1489309200, -21600, 3600, 'MDT'),
+        (1509868800, -25200, 0, 'MST'),
+        (1520758800, -21600, 3600, 'MDT'),
+        (1541318400, -25200, 0, 'MST'),
+        (1552208400, -21600, 3600, 'MDT'),
+        (1572768000, -25200, 0, 'MST'),
+        (1583658000, -21600, 3600, 'MDT'),
+        (1604217600, -25200, 0, 'MST'),
+        (1615712400, -21600, 3600, 'MDT'),
+        (1636272000, -25200, 0, 'MST'),
+        (1647162000, -21600, 3600, 'MDT'),
+        (1667721600, -25200, 0, 'MST'),
+        (1678611600, -21600, 3600, 'MDT'),
+        (1699171200, -25200, 0, 'MST'),
+        (1710061200, -21600, 3600, 'MDT'),
+        (1730620800, -25200, 0, 'MST'),
+        (1741510800, -21600, 3600, 'MDT'),
+        (1762070400, -25200, 0, 'MST'),
+        (1772960400, -21600, 3600, 'MDT'),
+        (1793520000, -25200, 0, 'MST'),
+        (1805014800, -21600, 3600, 'MDT'),
+        (1825574400, -25200, 0, 'MST'),
+        (1836464400, -21600, 3600, 'MDT'),
+        (1857024000, -25200, 0, 'MST'),
+        (1867914000, -21600, 3600, 'MDT'),
+        (1888473600, -25200, 0, 'MST'),
+        (1899363600, -21600, 3600, 'MDT'),
+        (1919923200, -25200, 0, 'MST'),
+        (1930813200, -21600, 3600, 'MDT'),
+        (1951372800, -25200, 0, 'MST'),
+        (1962867600, -21600, 3600, 'MDT'),
+        (1983427200, -25200, 0, 'MST'),
+        (1994317200, -21600, 3600, 'MDT'),
+        (2014876800, -25200, 0, 'MST'),
+        (2025766800, -21600, 3600, 'MDT'),
+        (2046326400, -25200, 0, 'MST'),
+        (2057216400, -21600, 3600, 'MDT'),
+        (2077776000, -25200, 0, 'MST'),
+        (2088666000, -21600, 3600, 'MDT'),
+        (2109225600, -25200, 0, 'MST'),
+        (2120115600, -21600, 3600, 'MDT'),
+        (2140675200, -25200, 0, 'MST'),
+    ),
+}
@@ -1,18 +1,164 @@
-import datetime
+import json
+import time
 import webapp2
 
-from google.appengine.ext.webapp import template
 from google.appengine.ext import ndb
 from google.appengine.api import taskqueue
 
-from views_base import ViewBase, redirect_locked
+from views_base import (ViewBase, redirect_locked, cache_anonymous_page,
+                        get_page_size)
 from models import (Show, Player, Action, Theme, ActionVote, ThemeVote,
                     LiveActionVote, RoleVote, LiveRoleVote,
                     VotingTest, LiveVotingTest,
-                    VOTE_AFTER_INTERVAL, ROLE_TYPES,
-                    get_current_show)
+                    ROLE_TYPES, LIVE_VOTE_TRANSACTION_SIZE,
+                    get_current_show, get_show_state, get_vote_round,
+                    delete_counted, insert_live_vote, insert_live_votes,
+                    get_unused_count, get_voted_ids, insert_upvote,
+                    count_upvote)
+from leaderboard import get_leaderboard_page
 from timezone import get_mountain_time, get_tomorrow_start
 
+# Collect live votes in a pull queue and record them in batches
+BATCH_LIVE_VOTES = True
+LIVE_VOTE_QUEUE = 'live-votes'
+LIVE_VOTE_BATCH_URI = '/live_vote_batch_worker/'
+# Most votes a single batch worker leases at once
+LIVE_VOTE_BATCH_SIZE = 500
+LIVE_VOTE_LEASE_SECONDS = 30
+# Seconds the batch worker waits for votes to collect
+LIVE_VOTE_BATCH_DELAY = 1
+# The last batch window this instance scheduled a worker for
+_scheduled_batch_window = None
+
+
+def schedule_live_vote_batch():
+    global _scheduled_batch_window
+    window = int(time.time()) / LIVE_VOTE_BATCH_DELAY
+    # Skip the task add if this instance already scheduled the window
+    if window == _scheduled_batch_window:
+        return
+    # Named tasks make sure there is only one batch worker per window
+    try:
+        taskqueue.add(url=LIVE_VOTE_BATCH_URI,
+                      name='live-vote-batch-%s' % window,
+                      countdown=LIVE_VOTE_BATCH_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    _scheduled_batch_window = window
+
+
+def get_cast_vote(show, vote_num, session_id):
+    """Resolve a live vote to the option it's for, as the vote is cast.
+
+    Batched votes are recorded a moment later, when the vote may already
+    have closed, so the vote is checked against the show state now and
+    everything needed to record it goes in the task. Returns None if no
+    vote is open or there's no such option.
+    """
+    if not show:
+        return None
+    vote_data = get_show_state(show.key.id())['vote_options']
+    # If we're not in the voting period
+    if vote_data.get('display') != 'voting':
+        return None
+    state = vote_data['state']
+    try:
+        voted_option = vote_data['options'][vote_num]
+    except (IndexError, KeyError):
+        return None
+    vote = {'show_id': show.key.id(),
+            'state': state,
+            'option_id': voted_option['id'],
+            'session_id': session_id}
+    if state == 'interval':
+        vote.update({'interval': vote_data['interval'],
+                     'player_id': vote_data['player_id']})
+    elif state == 'test':
+        vote['test_round'] = show.test_round
+    return vote
+
+
+def get_incident_player(show):
+    # Incident votes are attached to the hero
+    if show.hero:
+        return show.hero
+    # Before there is one, make sure there is at least SOME player
+    if getattr(show, '_any_player', None) is None:
+        show._any_player = Player.query().get(keys_only=True)
+    return show._any_player
+
+
+def build_live_vote(show, vote):
+    """Build the live vote of a vote cast from get_cast_vote.
+
+    Returns the live vote, along with the round and the key of the option
+    it's tallied under, or None if the vote can't be recorded.
+    """
+    state = vote['state']
+    session_id = str(vote['session_id'])
+    option_id = int(vote['option_id'])
+    if state in ['interval', 'incident']:
+        if state == 'interval':
+            interval = int(vote['interval'])
+            player = ndb.Key(Player, int(vote['player_id']))
+            vote_round = get_vote_round(show.key, state, interval)
+        else:
+            interval = -1
+            player = get_incident_player(show)
+            vote_round = get_vote_round(show.key, state)
+        live_vote = LiveActionVote(
+                        key=LiveActionVote.build_key(show.key, interval, session_id),
+                        action=ndb.Key(Action, option_id),
+                        player=player,
+                        show=show.key,
+                        interval=interval,
+                        created=get_mountain_time().date(),
+                        session_id=session_id)
+        return live_vote, vote_round, live_vote.action
+    elif state in ROLE_TYPES:
+        live_vote = LiveRoleVote(
+                        key=LiveRoleVote.build_key(show.key, state, session_id),
+                        show=show.key,
+                        player=ndb.Key(Player, option_id),
+                        role=state,
+                        session_id=session_id)
+        # Role tallies are kept on the player's role vote
+        return (live_vote, get_vote_round(show.key, state),
+                RoleVote.build_key(show.key, live_vote.player, state))
+    elif state == 'test':
+        test_round = int(vote['test_round'])
+        live_vote = LiveVotingTest(
+                        key=LiveVotingTest.build_key(show.key, test_round,
+                                                     session_id),
+                        test=ndb.Key(VotingTest, option_id),
+                        show=show.key,
+                        test_round=test_round,
+                        session_id=session_id)
+        return (live_vote, get_vote_round(show.key, state, test_round),
+                live_vote.test)
+    return None
+
+
+def record_live_votes(votes):
+    """Record a batch of live votes, each resolved when it was cast.
+
+    Votes are keyed by show, round and session, so duplicates are dropped
+    in memory, then against the recorded votes as the new votes and their
+    tallies are stored in transactions of LIVE_VOTE_TRANSACTION_SIZE.
+    """
+    show_keys = list(set([ndb.Key(Show, int(x['show_id'])) for x in votes]))
+    shows = dict([(x.key, x) for x in ndb.get_multi(show_keys) if x])
+    new_votes = {}
+    for vote in votes:
+        show = shows.get(ndb.Key(Show, int(vote['show_id'])))
+        built = show and build_live_vote(show, vote)
+        # Only the first vote of a session in the batch counts
+        if built and built[0].key not in new_votes:
+            new_votes[built[0].key] = built
+    tallied_votes = new_votes.values()
+    for i in range(0, len(tallied_votes), LIVE_VOTE_TRANSACTION_SIZE):
+        insert_live_votes(tallied_votes[i:i + LIVE_VOTE_TRANSACTION_SIZE])
+
 
 def pre_show_voting_post(type_name, entry_value_type, type_model, type_vote_model,
                          request, session_id, is_admin):
@@ -24,8 +170,6 @@ def pre_show_voting_post(type_name, entry_value_type, type_model, type_vote_mode
     upvote = request.get('upvote')
     # If a delete was requested on an entry
     delete_id = request.get('delete_id')
-    # Get the key to query with (i.e. ThemeVote.theme)
-    type_vote_key_query = getattr(type_vote_model, type_name, None)
     if entry_value:
         entity_data = {entry_value_type: entry_value,
                        'vote_value': 0,
@@ -33,14 +177,13 @@ def pre_show_voting_post(type_name, entry_value_type, type_model, type_vote_mode
         entity = type_model(**entity_data).put().get()
         context['created'] = True
     elif upvote:
-        entity_key = ndb.Key(type_model, int(upvote)).get().key
-        tv = type_vote_model.query(
-                type_vote_key_query == entity_key,
-                type_vote_model.session_id == session_id).get()
-        if not tv:
-            vote_data = {type_name: entity_key,
-                         'session_id': session_id}
-            type_vote_model(**vote_data).put()
+        entity_key = ndb.Key(type_model, int(upvote))
+        # Votes are keyed by entity and session, so a repeated vote is dropped
+        vote_data = {type_name: entity_key,
+                     'session_id': session_id}
+        insert_upvote(entity_key, type_vote_model(
+                        key=type_vote_model.build_key(entity_key, session_id),
+                        **vote_data))
     # If a delete was requested
     elif delete_id:
         # Fetch the them
@@ -48,55 +191,67 @@ def pre_show_voting_post(type_name, entry_value_type, type_model, type_vote_mode
         # Make sure the entry was either the session id that created it
         # Or this is an admin user
         if session_id == entity.session_id or is_admin:
-            entity.key.delete()
+            delete_counted([entity.key])
     
-    # If an new entity was created
-    if entity:
-        # Have to sort first by entity key, since we query on it. Dumb...
-        entities = type_model.query(type_model.used == False,
-                                  type_model.key != entity.key).fetch()
-        entities.sort(key=lambda x: (x.vote_value, x.created), reverse=True)
-        # If the entity wasn't deleted
-        if not delete_id:
-            # Add the newly added entity
-            entities.append(entity)
-    else:
-        entities = type_model.query(type_model.used == False,
-                                   ).order(-type_model.vote_value,
-                                     type_model.created).fetch()
-    context['%ss' % type_name] = entities
+    # The leaderboard already reflects any new, upvoted or deleted entity
+    entities, next_cursor = get_leaderboard_page(type_model,
+                                                 size=get_page_size(request))
+    context.update({'%ss' % type_name: entities,
+                    'next_cursor': next_cursor,
+                    'load_more_url': '/items_json/%s/' % type_name,
+                    'voted_ids': get_voted_ids(type_vote_model, entities,
+                                               session_id),
+                    'item_count': get_unused_count(type_model)})
     
     return context
 
 
 class MainPage(ViewBase):
     @redirect_locked
+    @cache_anonymous_page
     def get(self):
-        context = {'current_show': get_current_show()}
-        self.response.out.write(template.render(self.path('home.html'),
-                                                self.add_context(context)))
+        show = get_current_show()
+        context = {'current_show': show}
+        context['home_content'] = self.render_fragment('home_content.html',
+                                                       show, context)
+        self.response.out.write(self.render('home.html', context))
 
 
 class LiveVote(ViewBase):
     def get(self):
-        context = {'show': get_current_show()}
-        self.response.out.write(template.render(self.path('live_vote.html'),
-                                                self.add_context(context)))
+        show = get_current_show()
+        context = {'show': show,
+                   'live_vote_options': self.render_fragment(
+                                            'live_vote_options.html', show,
+                                            {'show': show})}
+        self.response.out.write(self.render('live_vote.html', context))
 
     def post(self):
         voted = True
         vote_num = int(self.request.get('vote_num', '0'))
         session_id = str(self.session.get('id'))
         
-        # Add the task to the default queue.
-        taskqueue.add(url='/live_vote_worker/',
-                      params={'show': self.context['current_show'],
-                              'vote_num': vote_num,
-                              'session_id': session_id})
-        context = {'show': self.context['current_show'],
-                   'voted': voted}
-        self.response.out.write(template.render(self.path('live_vote.html'),
-                                                self.add_context(context)))
+        if BATCH_LIVE_VOTES:
+            vote = get_cast_vote(self.context['current_show'], vote_num,
+                                 session_id)
+            # Add the vote to the pull queue for the next batch
+            if vote:
+                taskqueue.Queue(LIVE_VOTE_QUEUE).add(taskqueue.Task(
+                                payload=json.dumps(vote), method='PULL'))
+                schedule_live_vote_batch()
+        else:
+            # Add the task to the default queue.
+            taskqueue.add(url='/live_vote_worker/',
+                          params={'show': self.context['current_show'],
+                                  'vote_num': vote_num,
+                                  'session_id': session_id})
+        show = self.context['current_show']
+        context = {'show': show,
+                   'voted': voted,
+                   'live_vote_options': self.render_fragment(
+                                            'live_vote_options.html', show,
+                                            {'show': show})}
+        self.response.out.write(self.render('live_vote.html', context))
 
 
 class LiveVoteWorker(webapp2.RequestHandler):
@@ -120,74 +275,99 @@ class LiveVoteWorker(webapp2.RequestHandler):
             interval = int(vote_data['interval'])
             action = ndb.Key(Action, int(voted_option['id']))
             player = ndb.Key(Player, int(vote_data['player_id']))
-            # If the user hasn't already voted
-            if not player.get().get_live_action_vote_exists(show.key, interval, session_id):
-                LiveActionVote(action=action,
-                               player=player,
-                               show=show.key,
-                               interval=interval,
-                               created=get_mountain_time().date(),
-                               session_id=session_id).put()
+            # Store the vote, unless the user already voted
+            insert_live_vote(LiveActionVote(
+                           key=LiveActionVote.build_key(show.key, interval, session_id),
+                           action=action,
+                           player=player,
+                           show=show.key,
+                           interval=interval,
+                           created=get_mountain_time().date(),
+                           session_id=session_id))
         # Submitting a player role vote
         elif state in ROLE_TYPES:
             player = ndb.Key(Player, int(voted_option['id']))
-            role_vote = player.get().get_role_vote(show, state)
-            # If no role vote exists for this user
-            if not role_vote:
-                # Create an initial Role vote
-                role_vote = RoleVote(show=show.key,
-                                     player=player,
-                                     role=state).put()
-            else:
-                role_vote = role_vote.key
-            # If the user hasn't already submitted a live role vote
-            if not role_vote.get().get_live_role_vote_exists(show.key, state, session_id):
-                # Create the live role vote
-                LiveRoleVote(show=show.key,
-                             player=player,
-                             role=state,
-                             session_id=session_id).put()
+            # Store the live role vote, unless the user already voted
+            insert_live_vote(LiveRoleVote(
+                         key=LiveRoleVote.build_key(show.key, state, session_id),
+                         show=show.key,
+                         player=player,
+                         role=state,
+                         session_id=session_id))
         # Submitting an incident vote
         elif state == 'incident':
             interval = -1
             action = ndb.Key(Action, int(voted_option['id']))
-            # If the user hasn't already voted for the incident
-            if not action.get().get_live_action_vote_exists(show.key, interval, session_id):
-                # If we haven't selected a hero yet
-                if not show.hero:
-                    # Make sure there is at least SOME player to attach the vote to
-                    vote_player = Player.query().get().key
-                else:
-                    vote_player = show.hero
-                LiveActionVote(action=action,
-                               show=show.key,
-                               player=vote_player,
-                               interval=interval,
-                               created=get_mountain_time().date(),
-                               session_id=session_id).put()
+            # If we haven't selected a hero yet
+            if not show.hero:
+                # Make sure there is at least SOME player to attach the vote to
+                vote_player = Player.query().get(keys_only=True)
+            else:
+                vote_player = show.hero
+            # Store the vote, unless the user already voted for the incident
+            insert_live_vote(LiveActionVote(
+                           key=LiveActionVote.build_key(show.key, interval, session_id),
+                           action=action,
+                           show=show.key,
+                           player=vote_player,
+                           interval=interval,
+                           created=get_mountain_time().date(),
+                           session_id=session_id))
         # Submitting an item vote
         elif state == 'test':
             test = ndb.Key(VotingTest, int(voted_option['id']))
-            # If the user hasn't already voted for an item
-            if not test.get().get_live_test_vote_exists(show.key, session_id):
-                LiveVotingTest(test=test,
-                               show=show.key,
-                               session_id=session_id).put()
+            # Store the vote, unless the user already voted for an item
+            insert_live_vote(LiveVotingTest(
+                           key=LiveVotingTest.build_key(show.key, show.test_round,
+                                                        session_id),
+                           test=test,
+                           show=show.key,
+                           test_round=show.test_round,
+                           session_id=session_id))
+
+
+class UpvoteWorker(webapp2.RequestHandler):
+    def post(self):
+        # A failed transaction fails the task, which the queue retries
+        count_upvote(ndb.Key(urlsafe=self.request.get('vote_key')))
+
+
+class LiveVoteBatchWorker(webapp2.RequestHandler):
+    def post(self):
+        queue = taskqueue.Queue(LIVE_VOTE_QUEUE)
+        tasks = queue.lease_tasks(LIVE_VOTE_LEASE_SECONDS, LIVE_VOTE_BATCH_SIZE)
+        if not tasks:
+            return
+        # The votes were checked against the open vote as they were cast
+        try:
+            record_live_votes([json.loads(x.payload) for x in tasks])
+        except Exception:
+            # The leased votes stay locked until the lease runs out, which
+            # is after the retries of this task, so pick them up then
+            taskqueue.add(url=LIVE_VOTE_BATCH_URI,
+                          countdown=LIVE_VOTE_LEASE_SECONDS)
+            raise
+        queue.delete_tasks(tasks)
+        # If the batch was full, there are probably more votes waiting
+        if len(tasks) == LIVE_VOTE_BATCH_SIZE:
+            taskqueue.add(url=LIVE_VOTE_BATCH_URI)
 
 
 class AddActions(ViewBase):
     
     @redirect_locked
     def get(self):
-        actions = Action.query(
-            Action.used == False).order(-Action.vote_value,
-                                        Action.created).fetch()
+        actions, next_cursor = get_leaderboard_page(
+                                    Action, size=get_page_size(self.request))
+        session_id = str(self.session.get('id', '0'))
         context = {'actions': actions,
+                   'next_cursor': next_cursor,
+                   'load_more_url': '/items_json/action/',
                    'show': get_current_show(),
-                   'session_id': str(self.session.get('id', '0')),
-                   'item_count': len(actions)}
-        self.response.out.write(template.render(self.path('add_actions.html'),
-                                                self.add_context(context)))
+                   'session_id': session_id,
+                   'voted_ids': get_voted_ids(ActionVote, actions, session_id),
+                   'item_count': get_unused_count(Action)}
+        self.response.out.write(self.render('add_actions.html', context))
 
     @redirect_locked
     def post(self):
@@ -199,24 +379,24 @@ class AddActions(ViewBase):
                                        str(self.session.get('id', '0')),
                                        self.context.get('is_admin', False))
         context['show'] = get_current_show()
-        context['item_count'] = len(context.get('actions', 0))
             
-        self.response.out.write(template.render(self.path('add_actions.html'),
-                                                self.add_context(context)))
+        self.response.out.write(self.render('add_actions.html', context))
 
         
 
 class AddThemes(ViewBase):
     @redirect_locked
     def get(self):
-        themes = Theme.query(
-                    Theme.used == False).order(-Theme.vote_value,
-                                               Theme.created).fetch()
+        themes, next_cursor = get_leaderboard_page(
+                                    Theme, size=get_page_size(self.request))
+        session_id = str(self.session.get('id', '0'))
         context = {'themes': themes,
-                   'session_id': str(self.session.get('id', '0')),
-                   'item_count': len(themes)}
-        self.response.out.write(template.render(self.path('add_themes.html'),
-                                                self.add_context(context)))
+                   'next_cursor': next_cursor,
+                   'load_more_url': '/items_json/theme/',
+                   'session_id': session_id,
+                   'voted_ids': get_voted_ids(ThemeVote, themes, session_id),
+                   'item_count': get_unused_count(Theme)}
+        self.response.out.write(self.render('add_themes.html', context))
 
     @redirect_locked
     def post(self):
@@ -227,13 +407,12 @@ class AddThemes(ViewBase):
                                        self.request,
                                        str(self.session.get('id', '0')),
                                        self.context.get('is_admin', False))
-        context['item_count'] = len(context.get('themes', 0))
             
-        self.response.out.write(template.render(self.path('add_themes.html'),
-                                                self.add_context(context)))
+        self.response.out.write(self.render('add_themes.html', context))
 
 
 class OtherShows(ViewBase):
+    @cache_anonymous_page
     def get(self, show_id=None):
         # If a show was specified
         if show_id:
@@ -250,5 +429,4 @@ class OtherShows(ViewBase):
                                     -Show.end_time).filter()
             context = {'future_shows': future_shows,
                        'previous_shows': previous_shows}
-        self.response.out.write(template.render(self.path('other_shows.html'),
-                                                self.add_context(context)))
+        self.response.out.write(self.render('other_shows.html', context))
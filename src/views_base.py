@@ -1,16 +1,41 @@
 import os
+import hashlib
 import random
-import datetime
+import time
 from functools import wraps
 
 import webapp2
 from webapp2_extras import sessions
+from google.appengine.ext.webapp import template
 from google.appengine.api import users
+from google.appengine.api import memcache
 
-from models import show_today, get_current_show
-from timezone import get_mountain_time
+from models import show_today, get_current_show, get_shows_version
+from leaderboard import PAGE_SIZE, MAX_PAGE_SIZE
 
 LIVE_VOTE_URI = '/live_vote/'
+FRAGMENT_KEY = 'fragment-%s-%s-%s-%s-%s'
+# Longest a rendered fragment is served, in case what it shows changes
+# without the show being saved
+FRAGMENT_TTL = 60
+# Rendered fragments held in this instance's memory, by fragment key
+_fragments = {}
+# Most fragments held in memory before they're all dropped
+FRAGMENT_LIMIT = 200
+# Absolute template paths, by file name
+_template_paths = {}
+CACHED_PAGE_KEY = 'page-%s-%s-%s'
+# Seconds a page is served from memcache, and from caches in front of the app
+CACHED_PAGE_TTL = 60
+CACHED_PAGE_MAX_AGE = 10
+
+
+def get_page_size(request):
+    try:
+        page_size = int(request.get('page_size', PAGE_SIZE))
+    except ValueError:
+        page_size = PAGE_SIZE
+    return min(max(page_size, 1), MAX_PAGE_SIZE)
 
 
 def redirect_locked(func):
@@ -23,38 +48,158 @@ def redirect_locked(func):
     return decorated_view
 
 
+def cache_anonymous_page(func):
+    """Serve a page to viewers who aren't logged in from a shared cache.
+
+    Only for pages that look the same to every anonymous viewer, as they
+    are cached by host, path and the version of the shows. Only successful
+    responses are cached.
+    """
+    @wraps(func)
+    def decorated_view(self, *args, **kwargs):
+        # Logged in users see their own navigation
+        if self.user:
+            return func(self, *args, **kwargs)
+        show = get_current_show()
+        version = '%s-%s-%s' % (get_shows_version(),
+                                show.key.id() if show else 0,
+                                show.version if show else 0)
+        # The login link on the page points back at the host it was served on
+        etag = hashlib.md5('%s-%s-%s' % (self.request.host, self.request.path_qs,
+                                         version)).hexdigest()
+        self.response.headers['Cache-Control'] = ('public, max-age=%s' %
+                                                  CACHED_PAGE_MAX_AGE)
+        # Logging in changes the page, and login is kept in a cookie
+        self.response.headers['Vary'] = 'Cookie'
+        self.response.headers['ETag'] = '"%s"' % etag
+        # If the viewer already has this version of the page
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return
+        page_key = CACHED_PAGE_KEY % (self.request.host, self.request.path_qs,
+                                      version)
+        page = memcache.get(page_key)
+        if page is None:
+            func(self, *args, **kwargs)
+            # Don't serve an error or redirect from any cache
+            if self.response.status_int == 200:
+                memcache.set(page_key, self.response.body, time=CACHED_PAGE_TTL)
+            else:
+                self.response.headers['Cache-Control'] = 'no-cache'
+                del self.response.headers['ETag']
+        else:
+            self.response.out.write(page)
+    return decorated_view
+
+
+class LazyContext(dict):
+    """A template context that computes each value the first time it's used.
+
+    loaders maps each key to a function returning its value. Values set
+    directly are used as they are.
+    """
+    def __init__(self, loaders):
+        super(LazyContext, self).__init__()
+        self.loaders = loaders
+
+    def __missing__(self, key):
+        if key not in self.loaders:
+            raise KeyError(key)
+        value = self.loaders[key]()
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.loaders
+
+    # Django template contexts look up keys with has_key
+    has_key = __contains__
+
+    def __len__(self):
+        return len(set(self.keys()) | set(self.loaders))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
 class ViewBase(webapp2.RequestHandler):
     def __init__(self, *args, **kwargs):
         super(ViewBase, self).__init__(*args, **kwargs)
         self.app = webapp2.get_app()
-        user = users.get_current_user()
-        if users.get_current_user():
-            auth_url = users.create_logout_url(self.request.uri)
-            auth_action = 'Logout'
-        else:
-            auth_url = users.create_login_url(self.request.uri)
-            auth_action = 'Login'
-        self.context = {
-                    'host_domain': self.request.host_url.replace('http://', ''),
-                    'image_path': self.app.registry.get('images'),
-                    'css_path': self.app.registry.get('css'),
-                    'js_path': self.app.registry.get('js'),
-                    'audio_path': self.app.registry.get('audio'),
-                    'player_image_path': self.app.registry.get('player_images'),
-                    'is_admin': users.is_current_user_admin(),
-                    'user': user,
-                    'auth_url': auth_url,
-                    'auth_action': auth_action,
-                    'path_qs': self.request.path_qs,
-                    'show_today': show_today(),
-                    'current_show': get_current_show()}
+
+    @webapp2.cached_property
+    def user(self):
+        return users.get_current_user()
+
+    def get_auth_url(self):
+        if self.user:
+            return users.create_logout_url(self.request.uri)
+        return users.create_login_url(self.request.uri)
+
+    @webapp2.cached_property
+    def context(self):
+        # Nothing is computed until a view or template asks for it
+        registry = self.app.registry
+        return LazyContext({
+                    'host_domain': lambda: self.request.host_url.replace('http://', ''),
+                    'image_path': lambda: registry.get('images'),
+                    'css_path': lambda: registry.get('css'),
+                    'js_path': lambda: registry.get('js'),
+                    'audio_path': lambda: registry.get('audio'),
+                    'player_image_path': lambda: registry.get('player_images'),
+                    'is_admin': users.is_current_user_admin,
+                    'user': lambda: self.user,
+                    'auth_url': self.get_auth_url,
+                    'auth_action': lambda: 'Logout' if self.user else 'Login',
+                    'path_qs': lambda: self.request.path_qs,
+                    'show_today': show_today,
+                    'current_show': get_current_show})
     
     def add_context(self, add_context={}):
         self.context.update(add_context)
         return self.context
     
     def path(self, filename):
-        return os.path.join(self.app.registry.get('templates'), filename)
+        template_path = _template_paths.get(filename)
+        if not template_path:
+            template_path = os.path.abspath(os.path.join(
+                                self.app.registry.get('templates'), filename))
+            _template_paths[filename] = template_path
+        return template_path
+
+    def render(self, filename, add_context={}):
+        # Templates are compiled once per instance, unless debugging
+        return template.render(self.path(filename),
+                               self.add_context(add_context), debug=False)
+
+    def render_fragment(self, filename, show, add_context={}):
+        """Render part of a page, shared by everyone viewing the same show.
+
+        The fragment is cached by the host, the show's version and whether
+        the viewer is an admin, so it can only use context that's the same
+        for all of them.
+        """
+        if show:
+            show_id, show_version = show.key.id(), show.version
+        else:
+            show_id, show_version = 0, 0
+        fragment_key = FRAGMENT_KEY % (self.request.host, filename, show_id,
+                                       show_version,
+                                       int(bool(self.context.get('is_admin'))))
+        fragment = _fragments.get(fragment_key)
+        if fragment and fragment[1] > time.time():
+            return fragment[0]
+        html = memcache.get(fragment_key)
+        if html is None:
+            html = self.render(filename, add_context)
+            memcache.set(fragment_key, html, time=FRAGMENT_TTL)
+        # Drop the fragments of older show versions
+        if len(_fragments) >= FRAGMENT_LIMIT:
+            _fragments.clear()
+        _fragments[fragment_key] = (html, time.time() + FRAGMENT_TTL)
+        return html
 
     def dispatch(self):
         self.session_store = sessions.get_store(request=self.request)
@@ -0,0 +1,59 @@
+import calendar
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from pytz.gae import pytz
+
+TABLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'src', 'tz_tables.py')
+HEADER = '''"""Time zone transitions, compiled from pytz's zoneinfo.zip.
+
+Generated by tools/build_tz_tables.py, don't edit by hand. Each row is the
+UTC epoch second the transition happens (None for the first), followed by
+the utc offset and daylight saving offset in seconds, and the zone name.
+"""
+
+OLSON_VERSION = %r
+
+TABLES = {'''
+
+
+def build_table(zone):
+    tz = pytz.timezone(zone)
+    rows = []
+    for i in range(0, len(tz._utc_transition_times)):
+        if i == 0:
+            transition = None
+        else:
+            transition = calendar.timegm(
+                            tz._utc_transition_times[i].timetuple())
+        utcoffset, dst, tzname = tz._transition_info[i]
+        rows.append((transition,
+                     utcoffset.days * 86400 + utcoffset.seconds,
+                     dst.seconds, tzname))
+    return rows
+
+
+def main():
+    usage = "usage: %prog [options] zone [zone ...]"
+    parser = OptionParser(usage)
+    (options, args) = parser.parse_args()
+    zones = args or ['America/Denver']
+    lines = [HEADER % pytz.OLSON_VERSION]
+    for zone in zones:
+        lines.append('    %r: (' % zone)
+        for row in build_table(zone):
+            lines.append('        %r,' % (row,))
+        lines.append('    ),')
+    lines.append('}')
+    with open(TABLES_PATH, 'w') as tables_file:
+        tables_file.write('\n'.join(lines) + '\n')
+    print "Wrote %s zone(s) to %s" % (len(zones), TABLES_PATH)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Check the cached leaderboard against a full ranking of the entities.
+
+Actions are ranked by a date property, which holds a datetime after a put
+and a date when read back from the datastore, so the entities here mix
+both, the way an updated board and a rebuilt one do.
+
+Run with the App Engine SDK on the python path.
+"""
+import datetime
+import os
+import pickle
+import random
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import leaderboard
+
+START = datetime.datetime(2015, 6, 1, 20)
+
+
+class FakeKey(object):
+    def __init__(self, entity_id):
+        self.entity_id = entity_id
+
+    def id(self):
+        return self.entity_id
+
+
+class FakeAction(object):
+    """Stands in for an Action, with just what the leaderboard reads."""
+    def __init__(self, entity_id):
+        self.key = FakeKey(entity_id)
+        self.vote_value = random.randint(0, 5)
+        self.used = False
+        self.set_created()
+
+    def set_created(self):
+        created = START + datetime.timedelta(hours=random.randint(0, 100))
+        # Read back from the datastore, or just put
+        if random.random() < 0.5:
+            created = created.date()
+        self.created = created
+
+
+def ranked(actions):
+    return [x[2] for x in sorted([leaderboard.Leaderboard.get_entry(x)
+                                  for x in actions if not x.used])]
+
+
+def check_leaderboard(count, size, changes):
+    actions = [FakeAction(x) for x in range(0, count)]
+    ranking = ranked(actions)
+    by_id = dict([(x.key.id(), x) for x in actions])
+    # Start from a partial board, the way it is rebuilt from a projection
+    board = leaderboard.Leaderboard([by_id[x] for x in ranking[:size + 1]],
+                                    complete=False)
+    for change in range(0, changes):
+        action = random.choice(actions)
+        roll = random.random()
+        if roll < 0.7:
+            action.vote_value += 1
+        elif roll < 0.8:
+            action.used = True
+        else:
+            action.set_created()
+        board.update(action)
+        # The board is stored in memcache between changes
+        board = pickle.loads(pickle.dumps(board))
+        ranking = ranked(actions)
+        if board.top() != ranking[:len(board)]:
+            raise AssertionError("Leaderboard out of order after change %s"
+                                 % change)
+
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option("-c", "--count", dest="count", default=30)
+    parser.add_option("-s", "--size", dest="size", default=10)
+    parser.add_option("-n", "--number", dest="number", default=2000)
+    (options, args) = parser.parse_args()
+    size = int(options.size)
+    leaderboard.LEADERBOARD_SIZE = size
+    check_leaderboard(int(options.count), size, int(options.number))
+    print "Leaderboard matches the full ranking"
+
+
+if __name__ == "__main__":
+    main()
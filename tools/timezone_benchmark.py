@@ -0,0 +1,91 @@
+"""Time the whole time zone part of a show state poll, before and after.
+
+Each poll gets the current mountain time and compares it against the start
+of every vote type, the way current_vote_state does.
+"""
+import datetime
+import os
+import sys
+import time
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from pytz.gae import pytz
+import timezone
+
+# Start times of the vote types current_vote_state checks on every poll
+VOTE_TIMES = [datetime.datetime(2015, 6, 1, 20, i) for i in range(0, 8)]
+
+
+class Mountain_tzinfo(datetime.tzinfo):
+    """The mountain time tzinfo timezone.py used to convert with."""
+    def utcoffset(self, dt):
+        return datetime.timedelta(hours=-7) + self.dst(dt)
+
+    def _FirstSunday(self, dt):
+        return dt + datetime.timedelta(days=(6-dt.weekday()))
+
+    def dst(self, dt):
+        dst_start = self._FirstSunday(datetime.datetime(dt.year, 3, 8, 2))
+        dst_end = self._FirstSunday(datetime.datetime(dt.year, 11, 1, 1))
+        if dst_start <= dt.replace(tzinfo=None) < dst_end:
+            return datetime.timedelta(hours=1)
+        else:
+            return datetime.timedelta(hours=0)
+
+
+def old_get_mountain_time():
+    mountain_time = datetime.datetime.fromtimestamp(
+        time.mktime(datetime.datetime.utcnow().timetuple()), Mountain_tzinfo())
+    return mountain_time.replace(tzinfo=None)
+
+
+def old_back_to_tz(date_time):
+    denver_tz = pytz.timezone('America/Denver')
+    return denver_tz.localize(date_time, is_dst=None)
+
+
+def old_poll():
+    # current_vote_state localized the current time and each vote time
+    now_tz = old_back_to_tz(old_get_mountain_time())
+    for vote_time in VOTE_TIMES:
+        old_back_to_tz(vote_time) <= now_tz
+
+
+def new_poll():
+    # current_vote_state now compares naive mountain times
+    now = timezone.get_mountain_time()
+    for vote_time in VOTE_TIMES:
+        vote_time <= now
+
+
+def check_conversions():
+    # Compare the precomputed transitions against pytz, every 15 minutes
+    denver_tz = pytz.timezone('America/Denver')
+    utc_time = datetime.datetime(2014, 1, 1)
+    while utc_time < datetime.datetime(2020, 1, 1):
+        expected = pytz.utc.localize(utc_time).astimezone(denver_tz)
+        if timezone.utc_to_mountain(utc_time) != expected.replace(tzinfo=None):
+            raise AssertionError("Wrong mountain time for %s UTC" % utc_time)
+        utc_time += datetime.timedelta(minutes=15)
+
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", dest="number", default=10000)
+    (options, args) = parser.parse_args()
+    number = int(options.number)
+    check_conversions()
+    old_ms = timeit.timeit(old_poll, number=number) * 1000 / number
+    new_ms = timeit.timeit(new_poll, number=number) * 1000 / number
+    print "Per poll before: %.4fms" % old_ms
+    print "Per poll after:  %.4fms" % new_ms
+    print "Speed up: %.1fx" % (old_ms / new_ms)
+
+
+if __name__ == "__main__":
+    main()